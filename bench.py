@@ -0,0 +1,360 @@
+# bench.py - Measure the performance of urlnorm.py
+# Copyright (C) 2010 Kurt McKee <contactme@kurtmckee.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import urlnorm
+
+def make_corpus(size, seed=0):
+    # A synthetic mix of URLs; no network access is required
+    rand = random.Random(seed)
+    hosts = ['Host%d.Example.' % i for i in range(200)]
+    urls = []
+    for i in range(size):
+        urls.append('http://%s:80/a/%d/../b/index.html?z=%d&a=%%7e%d' % (
+            rand.choice(hosts), rand.randint(0, 100), i, rand.randint(0, 9)))
+    return urls
+
+def make_hostname(rand):
+    kind = rand.randint(0, 5)
+    octets = [rand.randint(0, 255) for i in range(4)]
+    if kind == 0:
+        return '.'.join(map(str, octets))
+    elif kind == 1:
+        return '.'.join('0%o' % i for i in octets)
+    elif kind == 2:
+        return '.'.join('0x%X' % i for i in octets)
+    elif kind == 3:
+        return str((octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3])
+    labels = ['Www', 'blog', 'CDN%d' % rand.randint(0, 9), 'example', 'co', 'uk']
+    return '.'.join(rand.sample(labels, rand.randint(2, 4))) + rand.choice(['', '.'])
+
+def make_path(rand):
+    segments = []
+    for i in range(rand.randint(1, 16)):
+        segments.append(rand.choice(['a', 'b%d' % i, '.', '..', '', 'x%7ey', 'p%2Fq', '%41%42']))
+    return '/' + '/'.join(segments)
+
+def make_query(rand):
+    params = []
+    for i in range(rand.randint(0, 40)):
+        params.append('%s=%s' % (rand.choice(['utm_source', 'id', 'q', 'k%d' % i, 'a^b']),
+                                 rand.choice(['', '1', 'x y', 'caf%C3%A9', 'a=b', 'http://x/?y'])))
+    return '&'.join(params)
+
+def make_stage_corpus(size, seed=0):
+    # Returns (url, base) pairs; a quarter of them are relative URLs
+    rand = random.Random(seed)
+    pairs = []
+    for i in range(size):
+        url = '%s://%s%s/%s?%s' % (rand.choice(['http', 'HTTPS', 'feed:http']),
+                                   make_hostname(rand), rand.choice(['', ':80', ':8080']),
+                                   make_path(rand), make_query(rand))
+        base = None
+        if rand.random() < 0.25:
+            base = url
+            url = rand.choice(['../', './', '', '/']) + make_path(rand)[1:]
+        pairs.append((url, base))
+    return pairs
+
+def timeit(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+def bench_parallel(urls, processes):
+    print 'processes   seconds  URLs/s  speedup'
+    single = None
+    for n in processes:
+        elapsed = timeit(urlnorm.urlnorm_parallel, urls, None, n)
+        single = single or elapsed
+        print '%9d  %8.3f  %6d  %6.2fx' % (n, elapsed, len(urls) / elapsed, single / elapsed)
+
+def bench_threads(urls, counts):
+    # Split the URLs between threads while another thread keeps
+    # registering and unregistering a plugin, as a service that reloads
+    # its configuration would. urlnorm() reads the published pipeline
+    # without a lock, so the readers never wait for the registrations
+    print 'threads   seconds  URLs/s  speedup  registrations'
+    plugfn = lambda parts: parts
+    plugfn.hosts = ('reload.example',)
+    single = None
+    for n in counts:
+        stop = threading.Event()
+        registrations = [0]
+        def register():
+            while not stop.is_set():
+                urlnorm.register_post_plugin(plugfn)
+                urlnorm.unregister_post_plugin(plugfn)
+                registrations[0] += 1
+                time.sleep(0.001)
+        size = len(urls) // n + 1
+        threads = [threading.Thread(target=urlnorm.urlnorm_many, args=(urls[i:i + size],))
+                   for i in range(0, len(urls), size)]
+        registrar = threading.Thread(target=register)
+        registrar.start()
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        stop.set()
+        registrar.join()
+        single = single or elapsed
+        print '%7d  %8.3f  %6d  %6.2fx  %13d' % (n, elapsed, len(urls) / elapsed,
+                                                 single / elapsed, registrations[0])
+
+def bench_plugins(urls, counts=(0, 10, 50)):
+    # Register site-specific fixers that declare the hosts they apply to
+    print 'plugins   seconds  URLs/s'
+    try:
+        for n in counts:
+            urlnorm._post_plugins = []
+            for i in range(n):
+                plugfn = lambda parts: parts
+                plugfn.hosts = ('site%d.example' % i,)
+                urlnorm.register_post_plugin(plugfn)
+            elapsed = timeit(urlnorm.urlnorm_many, urls)
+            print '%7d  %8.3f  %6d' % (n, elapsed, len(urls) / elapsed)
+    finally:
+        urlnorm._post_plugins = []
+
+def time_stage(fn, items, repeat):
+    # Return the best time per item, in microseconds
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for item in items:
+            fn(*item)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e6 / len(items)
+
+def stage_inputs(pairs):
+    urls = [(url,) for url, base in pairs if base is None]
+    parts = [urlnorm._urlparse(url) for url, in urls]
+    parts = [p for p in parts if p is not None]
+    hostnames = [(urlnorm._split_netloc(p.netloc)['hostname'],) for p in parts]
+    return {
+        'urlnorm': (urlnorm.urlnorm, pairs),
+        '_urlparse': (urlnorm._urlparse, urls),
+        '_normalize_percent_encoding': (urlnorm._normalize_percent_encoding, urls),
+        '_normalize_hostname': (urlnorm._normalize_hostname, hostnames),
+        '_normalize_path': (urlnorm._normalize_path, [(p.path,) for p in parts]),
+        '_split_query': (urlnorm._split_query, [(p.query,) for p in parts]),
+        '_join_query': (urlnorm._join_query, [(urlnorm._split_query(p.query),) for p in parts]),
+    }
+
+def bench_stages(size, repeat):
+    results = {}
+    print 'stage                        usec/item'
+    for name, (fn, items) in sorted(stage_inputs(make_stage_corpus(size)).items()):
+        results[name] = time_stage(fn, items, repeat)
+        print '%-27s  %9.3f' % (name, results[name])
+    return results
+
+def compare(results, baseline, threshold):
+    # Return the names of the stages that regressed beyond `threshold`
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name] / baseline[name]
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            print 'REGRESSION: %s is %.1f%% slower than the baseline (%.3f vs %.3f usec)' % (
+                name, (ratio - 1) * 100, results[name], baseline[name])
+    return regressions
+
+def bench_query(counts=(10, 100, 1000, 10000), repeat=3):
+    # The time per parameter should stay flat as the query grows
+    print 'parameters  usec/parameter'
+    rand = random.Random(0)
+    for n in counts:
+        query = '&'.join('k%d=%s' % (rand.randint(0, n), rand.choice(['v', 'a b', 'x^y', '']))
+                         for i in range(n))
+        elapsed = time_stage(lambda q: urlnorm._join_query(urlnorm._split_query(q)),
+                             [(query,)], repeat)
+        print '%10d  %14.3f' % (n, elapsed / n)
+
+def bench_hostnames(size, repeat):
+    # Domain names should be much cheaper than the numeric forms
+    print 'hostnames        usec/hostname'
+    rand = random.Random(0)
+    kinds = {
+        'names': lambda: make_hostname(rand).replace('0', 'o') + 'x',
+        'dotted': lambda: '.'.join(str(rand.randint(0, 255)) for i in range(4)),
+        'octal-hex': lambda: '0%o.0x%X' % (rand.randint(0, 255), rand.randint(0, 1 << 24)),
+        'ipv6': lambda: '[2001:DB8:0:0:%x:0:0:%x]' % (rand.randint(0, 65535), rand.randint(1, 65535)),
+    }
+    for name in ('names', 'dotted', 'octal-hex', 'ipv6'):
+        hostnames = [(kinds[name](),) for i in range(size)]
+        print '%-15s  %13.3f' % (name, time_stage(urlnorm._normalize_hostname, hostnames, repeat))
+
+def bench_bytes(urls, repeat):
+    # Byte strings in and out, with and without the decode/encode round
+    # trip. The two are timed in alternation so that they see the same
+    # machine load, and the best and the median of the runs are reported
+    print 'bytes              min usec/URL  median usec/URL'
+    urls = [url.encode('utf-8') for url in urls]
+    def text(urls):
+        return [url.encode('utf-8') for url in
+                urlnorm.urlnorm_many([url.decode('utf-8') for url in urls])]
+    cases = (('decode + encode', text), ('urlnorm_bytes', urlnorm.urlnorm_bytes_many))
+    times = dict((name, []) for name, fn in cases)
+    for i in range(repeat):
+        for name, fn in cases:
+            times[name].append(timeit(fn, urls) * 1e6 / len(urls))
+    for name, fn in cases:
+        runs = sorted(times[name])
+        print '%-15s  %12.3f  %15.3f' % (name, runs[0], runs[len(runs) // 2])
+
+def bench_disk_cache(urls):
+    # A first run that fills the on-disk cache and repeat runs that read
+    # it back, the way a daily batch over mostly the same URLs would
+    print 'disk cache        seconds  URLs/s'
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'cache.db')
+    def run(name, warm=None):
+        if warm is not None:
+            urlnorm.enable_disk_cache(path, None, warm)
+        try:
+            elapsed = timeit(urlnorm.urlnorm_many, urls)
+        finally:
+            urlnorm.disable_disk_cache()
+        print '%-15s  %8.3f  %6d' % (name, elapsed, len(urls) / elapsed)
+    try:
+        run('no cache')
+        run('first run', 0)
+        run('repeat run', 0)
+        start = time.time()
+        run('warmed run', len(urls))
+        print '%-15s  %8.3f' % ('(with warming)', time.time() - start)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+STARTUP_CASES = (
+    ('interpreter', 'pass'),
+    ('import', 'import urlnorm'),
+    ('first URL', 'import urlnorm; urlnorm.urlnorm("http://D/")'),
+    ('plugins', 'import urlnorm; urlnorm.load_plugins(%(config)r); '
+                'urlnorm.urlnorm("http://www.D/index.html")'),
+    ('frozen plugins', 'import urlnorm; urlnorm.load_plugins(%(frozen)r); '
+                       'urlnorm.urlnorm("http://www.D/index.html")'),
+)
+
+def bench_startup(repeat):
+    # Time fresh interpreters, as short-lived workers would start them.
+    # The frozen snapshot declares where each plugin applies, so plugins
+    # that do not apply to the URL are never imported
+    print 'startup             msec'
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = {'config': os.path.join(tmpdir, 'config.json'),
+                 'frozen': os.path.join(tmpdir, 'frozen.json')}
+        with open(paths['config'], 'w') as f:
+            json.dump({'pre': ['msplinks'], 'post': ['nowww', 'indexes']}, f)
+        urlnorm.load_plugins(paths['config'])
+        urlnorm.urlnorm('http://www.D/index.html')
+        urlnorm.freeze_plugins(paths['frozen'])
+        cwd = os.path.dirname(os.path.abspath(urlnorm.__file__))
+        for name, code in STARTUP_CASES:
+            best = None
+            for i in range(repeat):
+                start = time.time()
+                subprocess.check_call([sys.executable, '-c', code % paths], cwd=cwd)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print '%-15s  %7.1f' % (name, best * 1000)
+    finally:
+        urlnorm._pre_plugins = []
+        urlnorm._post_plugins = []
+        for path in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, path))
+        os.rmdir(tmpdir)
+
+BENCHMARKS = ('stages', 'query', 'hostnames', 'bytes', 'startup', 'diskcache', 'plugins',
+              'threads', 'parallel')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark urlnorm.py.')
+    parser.add_argument('benchmarks', nargs='*', default=BENCHMARKS,
+        metavar='BENCHMARK', help='benchmarks to run: %s (default: all)' % ', '.join(BENCHMARKS))
+    parser.add_argument('--size', type=int, default=200000,
+        help='number of URLs in the corpus (default: %(default)s)')
+    parser.add_argument('--processes', default='1,2,4,8',
+        help='worker counts for the parallel benchmark (default: %(default)s)')
+    parser.add_argument('--threads', default='1,2,4,8',
+        help='thread counts for the threads benchmark (default: %(default)s)')
+    parser.add_argument('--stage-size', type=int, default=2000,
+        help='number of URLs in the stage corpus (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='times each stage is timed; the best time is kept (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE',
+        help='write the stage timings to FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+        help='compare the stage timings with a file written by --json')
+    parser.add_argument('--threshold', type=float, default=0.20,
+        help='fail when a stage is slower than the baseline by more than this '
+             'fraction (default: %(default)s)')
+    args = parser.parse_args(argv)
+    status = 0
+    if 'stages' in args.benchmarks:
+        results = bench_stages(args.stage_size, args.repeat)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'python': platform.python_version(), 'size': args.stage_size,
+                           'stages': results}, f, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)['stages']
+            if compare(results, baseline, args.threshold):
+                status = 1
+    if 'query' in args.benchmarks:
+        bench_query(repeat=args.repeat)
+    if 'hostnames' in args.benchmarks:
+        bench_hostnames(args.stage_size, args.repeat)
+    if 'startup' in args.benchmarks:
+        bench_startup(args.repeat)
+    urls = make_corpus(args.size)
+    if 'bytes' in args.benchmarks:
+        bench_bytes(urls, args.repeat)
+    if 'diskcache' in args.benchmarks:
+        bench_disk_cache(urls)
+    if 'plugins' in args.benchmarks:
+        bench_plugins(urls)
+    if 'threads' in args.benchmarks:
+        bench_threads(urls, [int(n) for n in args.threads.split(',')])
+    if 'parallel' in args.benchmarks:
+        bench_parallel(urls, [int(n) for n in args.processes.split(',')])
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
+
 _DIRECTORY_INDEXES = (
     'index.htm', 'index.html', 'index.php', 'index.jsp',
     'default.asp', 'default.aspx',
@@ -25,6 +27,7 @@ def plugfn(parts):
         if newpath[-1] in _DIRECTORY_INDEXES:
             parts['path'] = newpath[0] + '/'
     return parts
+plugfn.path_pattern = '(?:^|/)(?:%s)$' % '|'.join(map(re.escape, _DIRECTORY_INDEXES))
 
 if __name__ == '__main__':
     import unittest
@@ -25,6 +25,7 @@ def plugfn(url):
         except binascii.Error:
             pass
     return url
+plugfn.substrings = ('msplinks.com/',)
 
 if __name__ == '__main__':
     import unittest
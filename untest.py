@@ -14,8 +14,15 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import unittest
+import collections
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import unittest
 
 import urlnorm
 
@@ -60,12 +67,54 @@ hostnames = (
     ('0x20C.0x22B.0x238.0x257', '12.43.56.87'),
     # Domain with only hex characters (.ee is a valid TLD)
     ('ab.cd.ee.ee', 'ab.cd.ee.ee'),
+    # Hosts that only look numeric
+    ('09', '09'),
+    ('1.2.3.0x', '1.2.3.0x'),
+    ('1.2.3.4.5', '1.2.3.4.5'),
+    ('1..2', '1..2'),
+    ('example.1a', 'example.1a'),
+    # IPv6 addresses (RFC 5952)
+    ('[2001:DB8:0:0:0:0:0:1]', '[2001:db8::1]'),
+    ('[2001:0db8::0001]', '[2001:db8::1]'),
+    ('[2001:db8:0:0:1:0:0:1]', '[2001:db8::1:0:0:1]'),
+    ('[2001:db8:0:1:1:1:1:1]', '[2001:db8:0:1:1:1:1:1]'),
+    ('[0:0:0:0:0:0:0:0]', '[::]'),
+    ('[::1]', '[::1]'),
+    ('[1::]', '[1::]'),
+    ('[::ffff:12.43.56.87]', '[::ffff:12.43.56.87]'),
+    ('[::ffff:c2b:3857]', '[::ffff:12.43.56.87]'),
+    ('[64:ff9b::12.43.56.87]', '[64:ff9b::c2b:3857]'),
+    # Invalid IPv6 addresses are left alone
+    ('[1::2::3]', '[1::2::3]'),
+    ('[1:2:3:4:5:6:7:8:9]', '[1:2:3:4:5:6:7:8:9]'),
+    ('[12345::]', '[12345::]'),
+    ('[::1.2.3.256]', '[::1.2.3.256]'),
+    ('[v1.x]', '[v1.x]'),
 )
 for i in range(len(hostnames)):
     testcase = make_testcase(hostnames[i][0], hostnames[i][1])
     testcase.__doc__ = 'hostname %02i: %s' % (i, hostnames[i][0])
     setattr(TestHostname, 'test_hostname_%02i' % i, testcase)
 
+class TestPercentEncoding(unittest.TestCase):
+    def worker(self, txt, result):
+        self.assertEqual(urlnorm._normalize_percent_encoding(txt), result)
+
+percents = (
+    ('/a/b', '/a/b'),
+    ('%41%7e%2d', 'A~-'),
+    ('%7E%7e', '~~'),
+    ('%2f%2F%c3%A9', '%2F%2F%C3%A9'),
+    ('%aF%Fa', '%AF%FA'),
+    ('%%41', '%A'),
+    ('%4%zz%', '%4%zz%'),
+    ('a%41b%2fc', 'aAb%2Fc'),
+)
+for i in range(len(percents)):
+    testcase = make_testcase(percents[i][0], percents[i][1])
+    testcase.__doc__ = 'percent encoding %02i: %s' % (i, percents[i][0])
+    setattr(TestPercentEncoding, 'test_percent_%02i' % i, testcase)
+
 class TestPath(unittest.TestCase):
     def worker(self, path, result):
         self.assertEqual(urlnorm._normalize_path(path), result)
@@ -160,6 +209,15 @@ netlocs = (
     ('user:@domain.test', {'username': 'user', 'password': '', 'hostname': 'domain.test'}),
     ('user:pass@domain.test', {'username': 'user', 'password': 'pass', 'hostname': 'domain.test'}),
     ('user:pass@domain.test:81', {'port': '81', 'username': 'user', 'password': 'pass', 'hostname': 'domain.test'}),
+    ('user:p:s@domain.test', {'username': 'user', 'password': 'p:s', 'hostname': 'domain.test'}),
+    ('u@v@domain.test', {'username': 'u', 'hostname': 'v@domain.test'}),
+    ('user@', {'username': None, 'hostname': 'user@'}),
+    ('domain.test:', {'port': '', 'hostname': 'domain.test'}),
+    ('domain.test:x', {'port': '', 'hostname': ''}),
+    ('[::1]', {'hostname': '[::1]'}),
+    ('[::1]:81', {'port': '81', 'hostname': '[::1]'}),
+    ('user:pass@[::1]:', {'port': '', 'username': 'user', 'password': 'pass', 'hostname': '[::1]'}),
+    ('[::1]x', {'port': '', 'hostname': ''}),
 )
 for i in range(len(netlocs)):
     testcase = make_testcase(netlocs[i][0], netlocs[i][1])
@@ -180,6 +238,10 @@ urlparses = (
     ('domain.test', {'scheme': 'http', 'path': '', 'netloc': 'domain.test'}),
     ('domain.test:8080/', {'scheme': 'http', 'path': '/', 'netloc': 'domain.test:8080'}),
     ('domain.test:8080', {'scheme': 'http', 'path': '', 'netloc': 'domain.test:8080'}),
+    ('HTTPS://domain.test', {'scheme': 'https', 'path': '', 'netloc': 'domain.test'}),
+    ('http://domain.test/a;b/c;d?q;r#f?g', {'path': '/a;b/c', 'params': 'd', 'query': 'q;r', 'fragment': 'f?g'}),
+    ('http://domain.test#f/g', {'path': '', 'netloc': 'domain.test', 'fragment': 'f/g'}),
+    ('domain.test?q', {'scheme': 'http', 'path': '', 'netloc': 'domain.test', 'query': 'q'}),
 )
 for i in range(len(urlparses)):
     testcase = make_testcase(urlparses[i][0], urlparses[i][1])
@@ -200,13 +262,1004 @@ fullurls = (
     # Test whitespace stripping
     ((" http://d/p/ ",), "http://d/p/"),
     ((" p ", " http://d2/ "), "http://d2/p"),
+    (("//d/p",), "//d/p"),
+    (("HTTP://d/",), "http://d/"),
     (("http://d/\r1/\n2\r\n/3",), "http://d/1/2/3"),
+    (("http://[2001:DB8::0:1]:80/",), "http://[2001:db8::1]/"),
+    (("/p", "http://[::1]:8080/"), "http://[::1]:8080/p"),
 )
 for i in range(len(fullurls)):
     testcase = make_testcase(fullurls[i][0], fullurls[i][1])
     testcase.__doc__ = 'fullurls %02i: %s' % (i, fullurls[i])
     setattr(TestURLNorm, 'test_fullurls_%02i' % i, testcase)
 
+class TestFastPath(unittest.TestCase):
+    def worker(self, url, canonical):
+        self.assertEqual(urlnorm._is_canonical(url), canonical)
+        if canonical:
+            self.assertEqual(urlnorm.urlnorm(url), url)
+    def testCounters(self):
+        before = urlnorm.fast_path_info()
+        urlnorm.urlnorm('http://d/')
+        urlnorm.urlnorm('http://D/')
+        after = urlnorm.fast_path_info()
+        self.assertEqual(after['taken'] - before['taken'], 1)
+        self.assertEqual(after['missed'] - before['missed'], 1)
+    def testCountersThreads(self):
+        before = urlnorm.fast_path_info()
+        def worker():
+            urlnorm.urlnorm_many(['http://d/'] * 1000)
+            for i in range(1000):
+                urlnorm.urlnorm('http://d/')
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(urlnorm.fast_path_info()['taken'] - before['taken'], 4004)
+    def testPlugins(self):
+        urlnorm.register_post_plugin(lambda parts: {'path': '/x'})
+        try:
+            self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://d/x')
+        finally:
+            urlnorm._post_plugins = []
+
+canonicals = (
+    ('http://d/', True),
+    ('https://d.example:8080/a/b/?a=&a=1&b#f', True),
+    ('http://d/a%20b/%C3%A9', True),
+    ('http://d/~a/b.c/', True),
+    ('http://d', False),
+    ('HTTP://d/', False),
+    ('http://D/', False),
+    ('http://d./', False),
+    ('http://1.2.3.4/', False),
+    ('http://d.0x1f/', False),
+    ('http://d:80/', False),
+    ('https://d:443/', False),
+    ('http://d:/', False),
+    ('http://u@d/', False),
+    ('http://d//a', False),
+    ('http://d/a/./b', False),
+    ('http://d/a/..', False),
+    ('http://d/%7e', False),
+    ('http://d/%41', False),
+    ('http://d/a;p', False),
+    ('http://d/?', False),
+    ('http://d/#', False),
+    ('http://d/?b&a', False),
+    ('http://d/?a=2&a=1', False),
+    ('http://d/?a&&b', False),
+    ('http://d/?a==', False),
+    ('http://d/?a^', False),
+    ('http://d/?a%20', False),
+    (' http://d/', False),
+)
+for i in range(len(canonicals)):
+    testcase = make_testcase(canonicals[i][0], canonicals[i][1])
+    testcase.__doc__ = 'canonical %02i: %s' % (i, canonicals[i][0])
+    setattr(TestFastPath, 'test_canonical_%02i' % i, testcase)
+
+class TestURLNormMany(unittest.TestCase):
+    def testMatchesURLNorm(self):
+        urls = [args[0] for args, expected in fullurls if len(args) == 1]
+        self.assertEqual(urlnorm.urlnorm_many(urls),
+                         [urlnorm.urlnorm(url) for url in urls])
+    def testBase(self):
+        self.assertEqual(urlnorm.urlnorm_many([' p ', '/q', 'p'], ' http://d2/ '),
+                         ['http://d2/p', 'http://d2/q', 'http://d2/p'])
+    def testIterable(self):
+        urls = ('http://D%d/' % (i % 3) for i in range(6))
+        self.assertEqual(urlnorm.urlnorm_many(urls),
+                         ['http://d0/', 'http://d1/', 'http://d2/'] * 2)
+    def testEmpty(self):
+        self.assertEqual(urlnorm.urlnorm_many([]), [])
+
+class TestBytes(unittest.TestCase):
+    def worker(self, url, base):
+        expected = urlnorm.urlnorm(url.decode('utf-8'), base and base.decode('utf-8'))
+        result = urlnorm.urlnorm_bytes(url, base)
+        self.assertEqual(result, expected.encode('utf-8'))
+        self.assertTrue(type(result) is str)
+    def testBytesLike(self):
+        self.assertEqual(urlnorm.urlnorm_bytes(bytearray('D/%7e'), memoryview('http://b/')),
+                         'http://b/D/~')
+        self.assertEqual(urlnorm.urlnorm_bytes_many([memoryview('D'), bytearray('E')]),
+                         ['http://d/', 'http://e/'])
+        self.assertRaises(TypeError, urlnorm.urlnorm_bytes, u'd')
+    def testByteStringsStayBytes(self):
+        self.assertTrue(type(urlnorm.urlnorm('http://012.0x1/%7e?a=%e9')) is str)
+    def testUnicodeCache(self):
+        urlnorm.enable_cache()
+        try:
+            urlnorm.urlnorm(u'D/%7e')
+            self.assertTrue(type(urlnorm.urlnorm_bytes('D/%7e')) is str)
+        finally:
+            urlnorm.disable_cache()
+
+byteurls = (
+    ('http://D/a/../%7e?b=1&a', None),
+    ('feed:http://d/\r\np', None),
+    ('http://012.0x1/', None),
+    ('p/q?x y', 'http://D:80/a/b'),
+    ('http://d/caf\xc3\xa9?caf\xc3\xa9', None),
+    ('http://\xc3\x89xample/', None),
+    (' http://d/\xc2\xa0', None),
+    ('p', 'http://d/\xc3\xa9/'),
+    ('irc://d/room', None),
+)
+for i in range(len(byteurls)):
+    testcase = make_testcase(byteurls[i][0], byteurls[i][1])
+    testcase.__doc__ = 'bytes %02i: %r' % (i, byteurls[i])
+    setattr(TestBytes, 'test_bytes_%02i' % i, testcase)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+class TestArrays(unittest.TestCase):
+    def testBuffers(self):
+        # The Arrow layout of ['D', None, 'http://E:80/', 'D'], sliced at 1
+        data = 'xDhttp://E:80/D'
+        offsets = [1, 2, 2, 14, 15]
+        validity = chr(0x0d)
+        self.assertEqual(urlnorm._normalize_buffers(data, offsets, validity, 0, None),
+                         ['http://d/', None, 'http://e/', 'http://d/'])
+        self.assertEqual(urlnorm._normalize_buffers(data, offsets[1:], validity, 1, None),
+                         [None, 'http://e/', 'http://d/'])
+        self.assertEqual(urlnorm._normalize_buffers('', [0, 0], None, 0, None), ['http:///'])
+    def testRepeatedValues(self):
+        calls = []
+        def normalize_many(urls, base):
+            calls.append(sorted(urls))
+            return urlnorm.urlnorm_many(urls, base)
+        self.assertEqual(urlnorm._normalize_column(['D', None, 'E', 'D'], None, normalize_many),
+                         ['http://d/', None, 'http://e/', 'http://d/'])
+        self.assertEqual(calls, [['D', 'E']])
+    def testUnsupported(self):
+        self.assertRaises(TypeError, urlnorm.urlnorm_array, ['D'])
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def testNumPy(self):
+        result = urlnorm.urlnorm_array(numpy.array(['D', None, float('nan'), u'E'], dtype=object))
+        self.assertEqual(result.dtype, numpy.dtype(object))
+        self.assertEqual(result[[0, 1, 3]].tolist(), ['http://d/', None, 'http://e/'])
+        self.assertTrue(result[2] != result[2])
+        result = urlnorm.urlnorm_array(numpy.array([['D', 'E'], ['F', 'D']]))
+        self.assertEqual(result.dtype.kind, 'S')
+        self.assertEqual(result.tolist(), [['http://d/', 'http://e/'], ['http://f/', 'http://d/']])
+        result = urlnorm.urlnorm_array(numpy.array([u'D']), 'http://b/')
+        self.assertEqual(result.tolist(), [u'http://b/D'])
+        self.assertRaises(TypeError, urlnorm.urlnorm_array, numpy.array([1]))
+    @unittest.skipIf(numpy is None or pyarrow is None, 'pyarrow is not installed')
+    def testArrow(self):
+        values = pyarrow.array([u'x', u'D', None, u'http://E:80/'])[1:]
+        result = urlnorm.urlnorm_array(values)
+        self.assertEqual(result.type, pyarrow.string())
+        self.assertEqual(result.to_pylist(), [u'http://d/', None, u'http://e/'])
+        chunked = pyarrow.chunked_array([[b'D'], [None]], type=pyarrow.binary())
+        self.assertEqual(urlnorm.urlnorm_array(chunked).to_pylist(), [b'http://d/', None])
+
+class TestBaseResolver(unittest.TestCase):
+    def tearDown(self):
+        urlnorm._pre_plugins = []
+        urlnorm._post_plugins = []
+    def worker(self, base, href):
+        resolver = urlnorm.BaseResolver(base)
+        self.assertEqual(resolver.resolve(href), urlnorm.urlnorm(href, base))
+    def testMany(self):
+        resolver = urlnorm.BaseResolver(' http://D/a/b ')
+        self.assertEqual(resolver.resolve_many(['c', '../c', 'c', '?q']),
+                         ['http://d/a/c', 'http://d/c', 'http://d/a/c', 'http://d/a/b?q'])
+    def testPrePlugin(self):
+        resolver = urlnorm.BaseResolver('http://d/a/')
+        urlnorm.register_pre_plugin(lambda url: url.replace('/a/', '/z/'))
+        self.assertEqual(resolver.resolve('b'), 'http://d/z/b')
+    def testPostPlugin(self):
+        resolver = urlnorm.BaseResolver('http://d/a/')
+        urlnorm.register_post_plugin(lambda parts: {'fragment': 'x'})
+        self.assertEqual(resolver.resolve('b'), 'http://d/a/b#x')
+    def testInvalidBase(self):
+        resolver = urlnorm.BaseResolver('http://[d/')
+        self.assertRaises(ValueError, resolver.resolve, 'a')
+
+resolutions = (
+    ('http://d/a/b;p?q#f', ''),
+    ('http://d/a/b;p?q#f', 'g'),
+    ('http://d/a/b;p?q#f', './g/'),
+    ('http://d/a/b;p?q#f', '/g'),
+    ('http://d/a/b;p?q#f', '//g/h'),
+    ('http://d/a/b;p?q#f', '?y'),
+    ('http://d/a/b;p?q#f', '#s'),
+    ('http://d/a/b;p?q#f', ';x'),
+    ('http://d/a/b;p?q#f', 'g;x?y#s'),
+    ('http://d/a/b;p?q#f', '../../../g'),
+    ('http://d/a/b;p?q#f', '..'),
+    ('http://d/a/b;p?q#f', 'g/..'),
+    ('http://d/a/b;p?q#f', '%2e%2E/g'),
+    ('http://d/a/b;p?q#f', 'g:h'),
+    ('http://d/a/b;p?q#f', 'feed:g'),
+    ('http://d/a/b;p?q#f', ' g\r\n/h '),
+    ('http://d/a;x/b', '../g;y'),
+    ('https://U:P@D:443', 'g'),
+    ('http://%41:80/%7e/', 'g%7e'),
+    ('http://[::1]:8080/', 'g'),
+    ('domain.test/a/', 'g'),
+    ('feed:http://d/a/', 'g'),
+    ('mailto:x@d', 'g'),
+    ('', 'g'),
+)
+for i in range(len(resolutions)):
+    testcase = make_testcase(resolutions[i][0], resolutions[i][1])
+    testcase.__doc__ = 'resolution %02i: %s' % (i, resolutions[i])
+    setattr(TestBaseResolver, 'test_resolution_%02i' % i, testcase)
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        urlnorm.enable_cache(maxsize=2)
+    def tearDown(self):
+        urlnorm.disable_cache()
+        urlnorm._pre_plugins = []
+    def testDisabled(self):
+        urlnorm.disable_cache()
+        self.assertEqual(urlnorm.cache_info(), None)
+    def testHitsAndMisses(self):
+        self.assertEqual(urlnorm.urlnorm('http://D/'), 'http://d/')
+        self.assertEqual(urlnorm.urlnorm('http://D/'), 'http://d/')
+        info = urlnorm.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+    def testBaseIsPartOfKey(self):
+        self.assertEqual(urlnorm.urlnorm('p', 'http://d1/'), 'http://d1/p')
+        self.assertEqual(urlnorm.urlnorm('p', 'http://d2/'), 'http://d2/p')
+    def testEviction(self):
+        for url in ('http://a/', 'http://b/', 'http://c/', 'http://a/'):
+            urlnorm.urlnorm(url)
+        info = urlnorm.cache_info()
+        self.assertEqual((info['hits'], info['evictions'], info['size']), (0, 2, 2))
+    def testSecondChance(self):
+        cache = urlnorm._LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['evictions']), (3, 1, 1))
+    def testMaxBytes(self):
+        urlnorm.enable_cache(maxsize=None, maxbytes=20)
+        urlnorm.urlnorm('http://a/')
+        urlnorm.urlnorm('http://b/')
+        info = urlnorm.cache_info()
+        self.assertEqual((info['size'], info['bytes']), (1, 18))
+    def testRegisterInvalidates(self):
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://d/')
+        urlnorm.register_pre_plugin(lambda u: 'http://x/')
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://x/')
+        self.assertEqual(urlnorm.cache_info()['hits'], 0)
+    def testMany(self):
+        urlnorm.urlnorm('http://D/')
+        self.assertEqual(urlnorm.urlnorm_many(['http://D/']), ['http://d/'])
+        self.assertEqual(urlnorm.cache_info()['hits'], 1)
+
+class TestHostCache(unittest.TestCase):
+    def setUp(self):
+        urlnorm.enable_host_cache(maxsize=2)
+    def tearDown(self):
+        urlnorm.enable_host_cache()
+    def testDisabled(self):
+        urlnorm.disable_host_cache()
+        self.assertEqual(urlnorm.host_cache_info(), None)
+        self.assertEqual(urlnorm.urlnorm('http://D:80/'), 'http://d/')
+    def testSharedAcrossURLs(self):
+        self.assertEqual(urlnorm.urlnorm('http://u@D:80/a'), 'http://u@d/a')
+        self.assertEqual(urlnorm.urlnorm('http://u@D:80/b'), 'http://u@d/b')
+        info = urlnorm.host_cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+    def testSchemeIsPartOfKey(self):
+        self.assertEqual(urlnorm.urlnorm('http://d:443/'), 'http://d:443/')
+        self.assertEqual(urlnorm.urlnorm('https://d:443/'), 'https://d/')
+    def testEviction(self):
+        for url in ('http://A/', 'http://B/', 'http://C/'):
+            urlnorm.urlnorm(url)
+        self.assertEqual(urlnorm.host_cache_info()['evictions'], 1)
+    def testPostPluginsCannotPoison(self):
+        def plugfn(parts):
+            parts['hostname'] = 'x'
+            return parts
+        urlnorm.register_post_plugin(plugfn)
+        try:
+            self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://x/')
+        finally:
+            urlnorm._post_plugins = []
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://d/')
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache.db')
+        urlnorm.enable_disk_cache(self.path, maxsize=3)
+    def tearDown(self):
+        urlnorm.disable_disk_cache()
+        urlnorm._pre_plugins = []
+        shutil.rmtree(self.tmpdir)
+    def reopen(self, **kwargs):
+        urlnorm.disable_disk_cache()
+        urlnorm.enable_disk_cache(self.path, maxsize=3, **kwargs)
+    def testDisabled(self):
+        urlnorm.disable_disk_cache()
+        self.assertEqual(urlnorm.disk_cache_info(), None)
+    def testOneExitHandler(self):
+        import atexit
+        for i in range(3):
+            self.reopen()
+        handlers = [h for h in atexit._exithandlers if h[0] is urlnorm.flush_disk_cache]
+        self.assertEqual(len(handlers), 1)
+    def testPersists(self):
+        self.assertEqual(urlnorm.urlnorm_many(['D/a', u'E/\xe9', 'D/a']),
+                         ['http://d/a', u'http://e/\xe9', 'http://d/a'])
+        self.assertEqual(urlnorm.disk_cache_info()['misses'], 2)
+        for warm in (0, 10):
+            self.reopen(warm=warm)
+            results = urlnorm.urlnorm_many(['D/a', u'E/\xe9'])
+            self.assertEqual(results, ['http://d/a', u'http://e/\xe9'])
+            self.assertEqual([type(i) for i in results], [str, unicode])
+            info = urlnorm.disk_cache_info()
+            self.assertEqual((info['hits'], info['misses'], info['warm']), (2, 0, min(warm, 2)))
+    def testSingleURLs(self):
+        self.assertEqual(urlnorm.urlnorm('p', 'http://D/'), 'http://d/p')
+        self.assertEqual(urlnorm.urlnorm('p', 'http://E/'), 'http://e/p')
+        self.assertEqual(urlnorm.disk_cache_info()['pending'], 2)
+        self.reopen()
+        self.assertEqual(urlnorm.urlnorm('p', 'http://D/'), 'http://d/p')
+        self.assertEqual(urlnorm.disk_cache_info()['hits'], 1)
+    def testMemoryCacheFirst(self):
+        urlnorm.enable_cache()
+        try:
+            for i in range(3):
+                self.assertEqual(urlnorm.urlnorm('D/a'), 'http://d/a')
+                self.assertEqual(urlnorm.urlnorm_many(['D/b', 'D/a']), ['http://d/b', 'http://d/a'])
+            info = urlnorm.disk_cache_info()
+            self.assertEqual((info['hits'], info['misses']), (0, 2))
+            # Results read from disk are kept in memory too
+            self.reopen()
+            urlnorm.clear_cache()
+            urlnorm.urlnorm('D/a')
+            urlnorm.urlnorm('D/a')
+            self.assertEqual(urlnorm.disk_cache_info()['hits'], 1)
+        finally:
+            urlnorm.disable_cache()
+    def testCanonicalURLsAreNotStored(self):
+        urlnorm.urlnorm('http://d/')
+        self.assertEqual(urlnorm.disk_cache_info()['pending'], 0)
+    def testPluginsArePartOfKey(self):
+        urlnorm.urlnorm_many(['D'])
+        urlnorm.register_pre_plugin(lambda u: 'http://x/')
+        self.assertEqual(urlnorm.urlnorm_many(['D']), ['http://x/'])
+        urlnorm._pre_plugins = []
+        self.assertEqual(urlnorm.urlnorm_many(['D']), ['http://d/'])
+        self.assertEqual(urlnorm.disk_cache_info()['hits'], 1)
+    def testReplaceClosure(self):
+        def make(path):
+            def plugfn(parts):
+                parts.path = path
+                return parts
+            return plugfn
+        a = make('/a')
+        urlnorm.register_post_plugin(a)
+        self.assertEqual(urlnorm.urlnorm_many(['http://D/x']), ['http://d/a'])
+        urlnorm.replace_post_plugin(a, make('/b'))
+        self.assertEqual(urlnorm.urlnorm_many(['http://D/x']), ['http://d/b'])
+        self.assertEqual(urlnorm.disk_cache_info()['hits'], 0)
+        urlnorm._post_plugins = []
+    def testUnidentifiedPlugins(self):
+        # Results of lambdas and closures over mutable values are not stored
+        urlnorm.register_pre_plugin(lambda url: url)
+        urlnorm.urlnorm_many(['D'])
+        urlnorm._pre_plugins = []
+        seen = []
+        def plugfn(url):
+            seen.append(url)
+            return url
+        urlnorm.register_pre_plugin(plugfn)
+        urlnorm.urlnorm_many(['D'])
+        self.assertEqual(urlnorm.disk_cache_info()['misses'], 0)
+    def testPluginFingerprint(self):
+        fingerprint = urlnorm._plugin_fingerprint
+        self.assertEqual(fingerprint(urlnorm._LazyPlugin('indexes')),
+                         fingerprint(urlnorm._LazyPlugin('indexes')))
+        self.assertNotEqual(fingerprint(urlnorm._LazyPlugin('indexes')),
+                            fingerprint(urlnorm._LazyPlugin('nowww')))
+        self.assertEqual(fingerprint(urlnorm._LazyPlugin('nowwww')), None)
+        self.assertEqual(fingerprint(self.reopen), None)
+    def testEviction(self):
+        for url in ('A', 'B', 'C', 'D', 'E'):
+            urlnorm.urlnorm(url)
+        urlnorm.flush_disk_cache()
+        info = urlnorm.disk_cache_info()
+        self.assertEqual((info['size'], info['evictions']), (3, 2))
+    def testSharedByProcesses(self):
+        self.assertEqual(urlnorm.urlnorm_parallel(['A', 'B'], processes=2, chunksize=1),
+                         ['http://a/', 'http://b/'])
+        self.assertEqual(urlnorm.disk_cache_info()['size'], 2)
+
+class TestFingerprint(unittest.TestCase):
+    def testEquivalentURLs(self):
+        self.assertEqual(urlnorm.fingerprint('D:80'), urlnorm.fingerprint(u'http://d/'))
+        self.assertNotEqual(urlnorm.fingerprint('d'), urlnorm.fingerprint('e'))
+    def testBits(self):
+        for bits in (32, 64, 128):
+            self.assertTrue(0 <= urlnorm.fingerprint('d', bits=bits) < 2 ** bits)
+        self.assertRaises(ValueError, urlnorm.fingerprint, 'd', bits=48)
+    def testMany(self):
+        self.assertEqual(urlnorm.fingerprint_many(['d', 'e'], 'http://b/'),
+                         [urlnorm.fingerprint('d', 'http://b/'), urlnorm.fingerprint('e', 'http://b/')])
+
+class TestDedupe(unittest.TestCase):
+    urls = ['D', 'http://d/', 'e', 'D:80', 'f']
+    expected = ['http://d/', 'http://e/', 'http://f/']
+    def testBloomFilter(self):
+        self.assertEqual(list(urlnorm.dedupe(iter(self.urls), chunksize=2)), self.expected)
+    def testFingerprintSet(self):
+        self.assertEqual(list(urlnorm.dedupe(self.urls, seen=urlnorm.FingerprintSet())),
+                         self.expected)
+    def testBloomFilterErrorRate(self):
+        seen = urlnorm.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            seen.add(urlnorm.fingerprint('d/%d' % i))
+            self.assertTrue(urlnorm.fingerprint('d/%d' % i) in seen)
+        false_positives = sum(urlnorm.fingerprint('e/%d' % i) in seen for i in range(1000))
+        self.assertTrue(false_positives < 30)
+
+class TestShards(unittest.TestCase):
+    domains = {
+        'd': 'd',
+        'www.d.example': 'd.example',
+        'a.b.d.co.uk': 'd.co.uk',
+        'a.d.io': 'd.io',
+        '10.0.0.1': '10.0.0.1',
+        '[::1]': '[::1]',
+        None: None,
+    }
+    def testRegistrableDomain(self):
+        for hostname, expected in self.domains.items():
+            self.assertEqual(urlnorm._registrable_domain(hostname), expected)
+    def testIndex(self):
+        self.assertEqual(urlnorm.urlnorm_shard('D/a', 8),
+                         ('http://d/a', urlnorm.shard_index('d', 8)))
+        self.assertTrue(0 <= urlnorm.shard_index('d', 8) < 8)
+        self.assertEqual(urlnorm.shard_index('a.d.example', 8, 'domain'),
+                         urlnorm.shard_index('b.d.example', 8, 'domain'))
+        self.assertRaises(ValueError, urlnorm.shard_index, 'd', 8, 'path')
+    def testFastPath(self):
+        # Canonical URLs are not parsed but get the same shard
+        self.assertEqual(urlnorm.urlnorm_shard('http://d:8080/a?b', 8)[1],
+                         urlnorm.shard_index('d', 8))
+    def testMany(self):
+        urls = ['/a', 'http://e/', '/b', 'mailto:x']
+        self.assertEqual(urlnorm.urlnorm_shard_many(urls, 4, 'http://d/'),
+                         [urlnorm.urlnorm_shard(url, 4, 'http://d/') for url in urls])
+        self.assertEqual(urlnorm.urlnorm_shard('mailto:x', 4)[1], urlnorm.shard_index(None, 4))
+
+class TestParallel(unittest.TestCase):
+    def tearDown(self):
+        urlnorm._post_plugins = []
+    def testOrder(self):
+        urls = ['D%d/a/../b' % i for i in range(25)]
+        self.assertEqual(urlnorm.urlnorm_parallel(urls, processes=2, chunksize=3),
+                         urlnorm.urlnorm_many(urls))
+    def testBase(self):
+        self.assertEqual(urlnorm.urlnorm_parallel(iter(['p']), 'http://d/', processes=2),
+                         ['http://d/p'])
+    def testPlugins(self):
+        def plugfn(parts):
+            parts['path'] += 'ath'
+            return parts
+        urlnorm.register_post_plugin(plugfn)
+        self.assertEqual(urlnorm.urlnorm_parallel(['http://d/p'], processes=2),
+                         ['http://d/path'])
+
+class TestService(unittest.TestCase):
+    address = ('127.0.0.1', 0)
+    def setUp(self):
+        self.server = urlnorm.make_server(self.address, cache_size=None)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.client = urlnorm.Client(self.server.server_address)
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+    def testNormalize(self):
+        self.assertEqual(self.client.normalize(['D', 'p'], 'http://b/'),
+                         ['http://b/D', 'http://b/p'])
+    def testPipelining(self):
+        batches = [['D%d/%d' % (i, j) for j in range(50)] for i in range(40)]
+        self.assertEqual(list(self.client.imap(batches, window=4)),
+                         [urlnorm.urlnorm_many(batch) for batch in batches])
+    def testStats(self):
+        self.client.normalize(['D'])
+        stats = self.client.stats()['stats']
+        self.assertEqual(stats['requests'], 1)
+        self.assertTrue(stats['p50'] <= stats['p99'])
+    def testError(self):
+        self.assertRaises(ValueError, self.client.normalize, [None])
+        self.assertEqual(self.client.normalize(['D']), ['http://d/'])
+    def testPipeliningError(self):
+        batches = [['D%d' % i] for i in range(40)]
+        batches[2] = [None]
+        results = self.client.imap(batches, window=4)
+        self.assertEqual(results.next(), ['http://d0/'])
+        self.assertEqual(results.next(), ['http://d1/'])
+        self.assertRaises(ValueError, results.next)
+        self.assertEqual(self.client.normalize(['D']), ['http://d/'])
+    def testPipeliningStop(self):
+        batches = [['D%d' % i] for i in range(40)]
+        results = self.client.imap(batches, window=4)
+        self.assertEqual(results.next(), ['http://d0/'])
+        results.close()
+        self.assertEqual(self.client.normalize(['D']), ['http://d/'])
+
+class TestUnixService(TestService):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, 'socket')
+        TestService.setUp(self)
+    def tearDown(self):
+        TestService.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.dst = os.path.join(self.tmpdir, 'dst')
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        urlnorm._pre_plugins = []
+        urlnorm._post_plugins = []
+    def worker(self, data, args=()):
+        with open(self.src, 'wb') as f:
+            f.write(data)
+        urlnorm.main(['-q', '-o', self.dst, self.src] + list(args))
+        with open(self.dst, 'rb') as f:
+            return f.read()
+    def testLines(self):
+        self.assertEqual(self.worker('D/a/../b\r\n\nD/c\n', ['--batch-size', '2']),
+                         'http://d/b\n\nhttp://d/c\n')
+    def testBase(self):
+        self.assertEqual(self.worker('p\n', ['--base', 'http://d/']), 'http://d/p\n')
+    def testProcesses(self):
+        data = ''.join('D%d\n' % i for i in range(10))
+        self.assertEqual(self.worker(data, ['-j', '2', '--batch-size', '3']),
+                         ''.join('http://d%d/\n' % i for i in range(10)))
+    def testJSONLines(self):
+        self.assertEqual(self.worker('{"u": "D"}\n{"v": "D"}\n', ['--jsonl-field', 'u']),
+                         '{"u": "http://d/"}\n{"v": "D"}\n')
+    def testFailuresPassThrough(self):
+        self.assertEqual(self.worker('\xff\nD\n'), '\xff\nhttp://d/\n')
+    def testQueryFilter(self):
+        try:
+            self.assertEqual(self.worker('d/?utm_x=1&a=1\n', ['--deny-param', 'utm_*']),
+                             'http://d/?a=1\n')
+        finally:
+            urlnorm.set_query_filter(None)
+    def testPlugins(self):
+        self.assertEqual(self.worker('www.d/index.html\n', ['--post-plugin', 'nowww',
+                                     '--post-plugin', 'indexes']), 'http://d/\n')
+
+class TestNormalizeFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.dst = os.path.join(self.tmpdir, 'dst')
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def worker(self, data, **kwargs):
+        with open(self.src, 'wb') as f:
+            f.write(data)
+        result = urlnorm.normalize_file(self.src, self.dst, **kwargs)
+        with open(self.dst, 'rb') as f:
+            return f.read(), result
+    def testLines(self):
+        data, result = self.worker('D/a/../b\r\n\n\xff\nD/c', chunk_size=3)
+        self.assertEqual(data, 'http://d/b\n\n\xff\nhttp://d/c\n')
+        self.assertEqual(result, {'lines': 4, 'failures': 1, 'offset': 16})
+    def testEmpty(self):
+        self.assertEqual(self.worker(''), ('', {'lines': 0, 'failures': 0, 'offset': 0}))
+    def testProcesses(self):
+        data = ''.join('D%d\n' % i for i in range(10))
+        self.assertEqual(self.worker(data, processes=2, chunk_size=5)[0],
+                         ''.join('http://d%d/\n' % i for i in range(10)))
+    def testJSONLines(self):
+        self.assertEqual(self.worker('{"u": "D"}\n', field='u')[0], '{"u": "http://d/"}\n')
+    def testResume(self):
+        # Pretend that a run was interrupted after the first line
+        with open(self.dst, 'wb') as f:
+            f.write('http://a/\npartial')
+        with open(self.checkpoint, 'wb') as f:
+            f.write('{"src": 2, "dst": 10}')
+        data, result = self.worker('A\nB\nC\n', chunk_size=1, checkpoint=self.checkpoint)
+        self.assertEqual(data, 'http://a/\nhttp://b/\nhttp://c/\n')
+        self.assertEqual(result['lines'], 2)
+        # The finished run leaves nothing to do
+        self.assertEqual(self.worker('A\nB\nC\n', checkpoint=self.checkpoint)[0],
+                         'http://a/\nhttp://b/\nhttp://c/\n')
+    def testCommandLine(self):
+        with open(self.src, 'wb') as f:
+            f.write('D\n')
+        urlnorm.main(['-q', '-o', self.dst, '--checkpoint', self.checkpoint, self.src])
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), 'http://d/\n')
+        self.assertTrue(os.path.exists(self.checkpoint))
+    def shards(self):
+        ret = []
+        for i in range(4):
+            with open('%s-%d' % (self.dst, i), 'rb') as f:
+                ret.append(f.read())
+        return ret
+    def expectedShards(self, urls):
+        ret = [''] * 4
+        for url, index in urlnorm.urlnorm_shard_many(urls, 4):
+            ret[index] += url + '\n'
+        return ret
+    def testShards(self):
+        urls = ['D%d/%d' % (i % 5, i) for i in range(20)]
+        with open(self.src, 'wb') as f:
+            f.write('\n'.join(urls))
+        result = urlnorm.normalize_file(self.src, self.dst + '-%d', processes=2,
+                                        chunk_size=10, shards=4)
+        self.assertEqual(result['lines'], 20)
+        self.assertEqual(self.shards(), self.expectedShards(urls))
+    def testShardsResume(self):
+        with open(self.src, 'wb') as f:
+            f.write('A\nB\nC\n')
+        paths = ['%s-%d' % (self.dst, i) for i in range(4)]
+        urlnorm.normalize_file(self.src, paths, chunk_size=1, shards=4,
+                               checkpoint=self.checkpoint)
+        with open(self.checkpoint, 'rb') as f:
+            self.assertEqual(len(json.load(f)['dst']), 4)
+        urlnorm.normalize_file(self.src, paths, shards=4, checkpoint=self.checkpoint)
+        self.assertEqual(self.shards(), self.expectedShards(['A', 'B', 'C']))
+    def testShardsPathCount(self):
+        with open(self.src, 'wb') as f:
+            f.write('A\n')
+        self.assertRaises(ValueError, urlnorm.normalize_file, self.src,
+                          [self.dst + '-0', self.dst + '-1'], shards=4)
+    def testCheckpointShape(self):
+        with open(self.src, 'wb') as f:
+            f.write('A\n')
+        paths = ['%s-%d' % (self.dst, i) for i in range(4)]
+        for state, kwargs in (('{"src": 0, "dst": 0}', {'shards': 4}),
+                              ('{"src": 0, "dst": [0, 0]}', {'shards': 4}),
+                              ('{"src": 0, "dst": [0, 0, 0, 0]}', {})):
+            with open(self.checkpoint, 'wb') as f:
+                f.write(state)
+            dst = paths if kwargs else self.dst
+            self.assertRaises(ValueError, urlnorm.normalize_file, self.src, dst,
+                              checkpoint=self.checkpoint, **kwargs)
+    def testShardsCommandLine(self):
+        with open(self.src, 'wb') as f:
+            f.write('a.d.example\nb.d.example\n')
+        urlnorm.main(['-q', '-o', self.dst + '-%d', '--shards', '4',
+                      '--shard-key', 'domain', self.src])
+        index = urlnorm.shard_index('d.example', 4, 'domain')
+        self.assertEqual(self.shards()[index], 'http://a.d.example/\nhttp://b.d.example/\n')
+
+class TestParsedURL(unittest.TestCase):
+    def testDictInterface(self):
+        parts = urlnorm.ParsedURL('http', path='/p')
+        self.assertEqual(parts['path'], '/p')
+        parts['path'] = '/q'
+        self.assertEqual(parts.path, '/q')
+        self.assertTrue('hostname' in parts)
+        self.assertFalse('spam' in parts)
+        self.assertEqual(parts.get('spam', 1), 1)
+        self.assertEqual(dict(parts.items())['scheme'], 'http')
+        self.assertEqual(sorted(parts), sorted(parts.keys()))
+        self.assertRaises(KeyError, parts.__getitem__, 'spam')
+        self.assertTrue(isinstance(parts, collections.MutableMapping))
+    def testDictIdioms(self):
+        parts = urlnorm.ParsedURL('http', hostname='d', path='/p')
+        self.assertTrue(parts.has_key('path'))
+        self.assertEqual(dict(parts.iteritems()), parts.copy())
+        self.assertEqual(type(parts.copy()), dict)
+        self.assertEqual(len(parts.values()), len(parts))
+        self.assertEqual(parts.setdefault('path', '/q'), '/p')
+        # Extra keys are kept but are not part of the URL
+        parts['spam'] = 1
+        self.assertEqual(parts.setdefault('eggs', 2), 2)
+        self.assertEqual((parts['spam'], parts.get('eggs')), (1, 2))
+        self.assertTrue('spam' in list(parts.iterkeys()))
+        self.assertEqual(parts.pop('spam'), 1)
+        self.assertFalse(parts.has_key('spam'))
+        del parts['path']
+        self.assertEqual(parts.path, '')
+        self.assertEqual(parts, dict(parts.items()))
+    def testLegacyPlugin(self):
+        def plugfn(parts):
+            parts = parts.copy()
+            parts['seen'] = True
+            if parts.has_key('path'):
+                parts['path'] = parts['path'].upper()
+            return parts
+        urlnorm.register_post_plugin(plugfn)
+        try:
+            self.assertEqual(urlnorm.urlnorm('http://d/p'), 'http://d/P')
+        finally:
+            urlnorm._post_plugins = []
+    def testUpdate(self):
+        parts = urlnorm.ParsedURL()
+        parts.update({'path': '/p'}, hostname='d')
+        self.assertEqual((parts.path, parts.hostname), ('/p', 'd'))
+        parts.update(parts)
+        self.assertEqual(parts.path, '/p')
+    def testNoSlotsDict(self):
+        self.assertFalse(hasattr(urlnorm.ParsedURL(), '__dict__'))
+    def testPluginReturningDict(self):
+        urlnorm.register_post_plugin(lambda parts: {'path': '/x'})
+        try:
+            self.assertEqual(urlnorm.urlnorm('http://d/p?q'), 'http://d/x?q')
+        finally:
+            urlnorm._post_plugins = []
+
+class TestPluginConfig(unittest.TestCase):
+    def tearDown(self):
+        urlnorm._pre_plugins = []
+        urlnorm._post_plugins = []
+        urlnorm.set_query_filter(None)
+    def testLazyImport(self):
+        urlnorm.load_plugins({'post': [{'module': 'nowww', 'hosts': ['d.example']}]})
+        plugin = urlnorm._post_plugins[0]
+        self.assertEqual(urlnorm.urlnorm('http://www.other.example/'), 'http://www.other.example/')
+        self.assertTrue(plugin.fn is None)
+        self.assertEqual(urlnorm.urlnorm('http://www.d.example/'), 'http://d.example/')
+        self.assertTrue(plugin.fn is not None)
+    def testAdoptDeclarations(self):
+        urlnorm.load_plugins({'pre': ['msplinks'], 'post': ['indexes']})
+        self.assertEqual(urlnorm.urlnorm('http://d/a/index.html'), 'http://d/a/')
+        self.assertEqual(urlnorm._post_plugins[0].path_pattern, urlnorm._load_plugin('indexes').path_pattern)
+        self.assertEqual(urlnorm._pre_plugins[0].substrings, ('msplinks.com/',))
+    def testUnknownModule(self):
+        self.assertRaises(ImportError, urlnorm.load_plugins, {'post': ['nowwww']})
+        self.assertRaises(ImportError, urlnorm.load_plugins, {'post': ['nowww.spam']})
+        self.assertEqual(len(urlnorm._post_plugins), 0)
+    def testCommandLineUnknownPlugin(self):
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+        try:
+            for option in ('--pre-plugin', '--post-plugin'):
+                with self.assertRaises(SystemExit) as cm:
+                    urlnorm.main(['-q', option, 'nowwww', os.devnull])
+                self.assertEqual(cm.exception.code, 2)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+    def testUnknownDeclaration(self):
+        self.assertRaises(TypeError, urlnorm.load_plugins, {'post': [{'module': 'nowww', 'host': 'd'}]})
+    def testFreeze(self):
+        urlnorm.load_plugins({'post': ['nowww', 'indexes'],
+                              'query_filter': {'deny': ['utm_*']}})
+        urlnorm.urlnorm('http://www.d/index.html?utm_x=1')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'plugins.json')
+            config = urlnorm.freeze_plugins(path)
+            self.assertEqual(config['post'][1]['path_pattern'], urlnorm._post_plugins[1].path_pattern)
+            urlnorm._post_plugins = []
+            urlnorm.set_query_filter(None)
+            urlnorm.load_plugins(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(urlnorm.urlnorm('http://www.d/index.html?utm_x=1&a=1'), 'http://d/?a=1')
+        self.assertEqual(urlnorm.freeze_plugins(), config)
+    def testFreezeFunction(self):
+        urlnorm.register_post_plugin(urlnorm._normalize_parts)
+        self.assertEqual(urlnorm.freeze_plugins()['post'],
+                         [{'module': 'urlnorm', 'function': '_normalize_parts'}])
+        urlnorm.register_post_plugin(lambda parts: parts)
+        self.assertRaises(ValueError, urlnorm.freeze_plugins)
+    def testCommandLine(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config = os.path.join(tmpdir, 'plugins.json')
+            src = os.path.join(tmpdir, 'src')
+            dst = os.path.join(tmpdir, 'dst')
+            with open(config, 'wb') as f:
+                f.write('{"post": ["nowww"]}')
+            with open(src, 'wb') as f:
+                f.write('www.d\n')
+            urlnorm.main(['-q', '--plugins', config, '-o', dst, src])
+            with open(dst, 'rb') as f:
+                self.assertEqual(f.read(), 'http://d/\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestStartup(unittest.TestCase):
+    def testLazyPatterns(self):
+        pattern = urlnorm._LazyPattern('a+')
+        self.assertFalse('match' in pattern.__dict__)
+        self.assertEqual(pattern.match('aab').group(), 'aa')
+        self.assertTrue('match' in pattern.__dict__)
+    def testLazyImports(self):
+        code = ('import sys, urlnorm; urlnorm.urlnorm("http://D/"); '
+                'print sorted(set(sys.modules) & set(["argparse", "imp", "mmap", '
+                '"multiprocessing", "Queue", "socket", "SocketServer", "urllib"]))')
+        output = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                                  cwd=os.path.dirname(os.path.abspath(urlnorm.__file__))).communicate()[0]
+        self.assertEqual(output.strip(), '[]')
+
+class TestPluginDeclarations(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+    def tearDown(self):
+        urlnorm._pre_plugins = []
+        urlnorm._post_plugins = []
+    def plugin(self, name, ret=None, **declarations):
+        def plugfn(arg):
+            self.calls.append(name)
+            return ret or arg
+        for k in declarations:
+            setattr(plugfn, k, declarations[k])
+        return plugfn
+    def testPreSubstrings(self):
+        urlnorm.register_pre_plugin(self.plugin('a', 'http://x/', substrings=['/a/']))
+        urlnorm.register_pre_plugin(self.plugin('b', substrings=['/b/']))
+        urlnorm.register_pre_plugin(self.plugin('c'))
+        self.assertEqual(urlnorm.urlnorm('http://d/b/'), 'http://d/b/')
+        self.assertEqual(self.calls, ['b', 'c'])
+        self.assertEqual(urlnorm.urlnorm('http://d/c/'), 'http://d/c/')
+        self.assertEqual(self.calls, ['b', 'c', 'c'])
+        self.assertEqual(urlnorm.urlnorm('http://d/a/'), 'http://x/')
+        self.assertEqual(self.calls, ['b', 'c', 'c', 'a', 'c'])
+    def testPostHosts(self):
+        urlnorm.register_post_plugin(self.plugin('a', hosts=['Domain.test']))
+        for url in ('http://domain.test/', 'http://www.domain.test/',
+                    'http://xdomain.test/', 'http://test/'):
+            urlnorm.urlnorm(url)
+        self.assertEqual(self.calls, ['a', 'a'])
+    def testPostPathPattern(self):
+        urlnorm.register_post_plugin(self.plugin('a', path_pattern='^/a'))
+        urlnorm.register_post_plugin(self.plugin('b', path_pattern='^/b', hosts=['d']))
+        urlnorm.register_post_plugin(self.plugin('c'))
+        for url in ('http://d/a', 'http://d/b', 'http://e/b', 'http://d/c'):
+            urlnorm.urlnorm(url)
+        self.assertEqual(self.calls, ['a', 'c', 'b', 'c', 'c', 'c'])
+    def testOrder(self):
+        # An earlier plugin can make a later plugin applicable
+        def plugfn(parts):
+            parts['hostname'] = 'x'
+            return parts
+        urlnorm.register_post_plugin(self.plugin('a', hosts=['d']))
+        urlnorm.register_post_plugin(plugfn)
+        urlnorm.register_post_plugin(self.plugin('b', hosts=['x']))
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://x/')
+        self.assertEqual(self.calls, ['a', 'b'])
+    def testPathPatternBackreference(self):
+        urlnorm.register_post_plugin(self.plugin('x', path_pattern=r'^/(x)y'))
+        urlnorm.register_post_plugin(self.plugin('a', path_pattern=r'^/(a)\1'))
+        urlnorm.register_post_plugin(self.plugin('i', path_pattern=r'(?i)^/I'))
+        urlnorm.register_post_plugin(self.plugin('b', path_pattern=r'^/b'))
+        for url in ('http://d/aa', 'http://d/xy', 'http://d/ix', 'http://d/b', 'http://d/B'):
+            urlnorm.urlnorm(url)
+        self.assertEqual(self.calls, ['a', 'x', 'i', 'b'])
+        self.assertEqual(len(urlnorm._current_pipeline().post_paths), 4)
+    def testUndeclaredFirst(self):
+        # The check that no declared plugin applies must not be made
+        # before an undeclared plugin has had a chance to change the URL
+        def plugfn(parts):
+            parts['hostname'] = 'x'
+            return parts
+        urlnorm.register_post_plugin(plugfn)
+        urlnorm.register_post_plugin(self.plugin('b', hosts=['x']))
+        self.assertEqual(urlnorm.urlnorm('http://e/'), 'http://x/')
+        self.assertEqual(self.calls, ['b'])
+    def testUndeclaredFirstPre(self):
+        urlnorm.register_pre_plugin(lambda url: url + 'msplinks.com/')
+        urlnorm.register_pre_plugin(self.plugin('b', substrings=['msplinks.com/']))
+        urlnorm.urlnorm('http://e/')
+        self.assertEqual(self.calls, ['b'])
+    def testRebinding(self):
+        urlnorm.register_pre_plugin(self.plugin('a'))
+        urlnorm.urlnorm('http://d/')
+        urlnorm._pre_plugins = []
+        urlnorm.urlnorm('http://d/')
+        self.assertEqual(self.calls, ['a'])
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        urlnorm.enable_stats()
+    def tearDown(self):
+        urlnorm.disable_stats()
+        urlnorm._post_plugins = []
+    def testDisabled(self):
+        urlnorm.disable_stats()
+        self.assertEqual(urlnorm.stats(), None)
+        self.assertEqual(urlnorm._urlparse.__name__, '_urlparse')
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://d/')
+    def testStages(self):
+        urlnorm.urlnorm('http://D/?q')
+        urlnorm.urlnorm('javascript:')
+        stats = urlnorm.stats()
+        self.assertEqual(stats['urlnorm']['calls'], 2)
+        self.assertEqual(stats['urlparse']['calls'], 2)
+        self.assertEqual(stats['path']['calls'], 1)
+        self.assertTrue(stats['urlnorm']['seconds'] >= stats['path']['seconds'])
+    def testMany(self):
+        self.assertEqual(urlnorm.urlnorm_many(['D/a', 'E/a', 'D/b']),
+                         ['http://d/a', 'http://e/a', 'http://d/b'])
+        stats = urlnorm.stats()
+        self.assertEqual(stats['urlnorm']['calls'], 3)
+        self.assertEqual(stats['path']['calls'], 2)
+    def testResolver(self):
+        resolver = urlnorm.BaseResolver('http://d/a/')
+        self.assertEqual(resolver.resolve_many(['b', '//e/', 'c']),
+                         ['http://d/a/b', 'http://e/', 'http://d/a/c'])
+        self.assertEqual(urlnorm.stats()['urlnorm']['calls'], 3)
+    def testPlugins(self):
+        def plugfn(parts):
+            return parts
+        urlnorm.register_post_plugin(plugfn)
+        urlnorm.urlnorm('http://d/')
+        self.assertEqual(urlnorm.stats()['post_plugin:%s.plugfn' % __name__]['calls'], 1)
+    def testReset(self):
+        urlnorm.urlnorm('http://d/')
+        urlnorm.reset_stats()
+        self.assertEqual(urlnorm.stats(), {})
+    def testThreads(self):
+        def worker():
+            for i in range(100):
+                urlnorm.urlnorm('http://d/%d' % i)
+        threads = [threading.Thread(target=worker) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(urlnorm.stats()['urlnorm']['calls'], 400)
+
+class TestQueryFilter(unittest.TestCase):
+    def tearDown(self):
+        urlnorm.set_query_filter(None)
+    def worker(self, url, expected, *args, **kwargs):
+        urlnorm.set_query_filter(urlnorm.QueryFilter(*args, **kwargs))
+        self.assertEqual(urlnorm.urlnorm(url), expected)
+    def testDeny(self):
+        self.worker('http://d/?fbclid=1&a=1', 'http://d/?a=1', ['fbclid'])
+    def testDenyPrefix(self):
+        self.worker('http://d/?utm_source=x&utm_medium=y&utm=1', 'http://d/?utm=1', ['utm_*'])
+    def testDenyGlob(self):
+        self.worker('http://d/?sessid=1&sess_id=2&session=3', 'http://d/?session=3', ['sess*id'])
+    def testAllow(self):
+        self.worker('http://d/?id=1&x=2&page=3', 'http://d/?id=1&page=3', allow=['id', 'p*'])
+    def testAllowAndDeny(self):
+        self.worker('http://d/?id=1&idx=2', 'http://d/?id=1', ['idx'], ['id*'])
+    def testAllRemoved(self):
+        self.worker('http://d/?a=1;a', 'http://d/', ['a'])
+    def testHosts(self):
+        qfilter = urlnorm.QueryFilter(['utm_*'], hosts={
+            'Shop.Example': {'deny': ['ref']},
+            'www.shop.example': {'allow': ['id', 'ref']},
+        })
+        urlnorm.set_query_filter(qfilter)
+        self.assertEqual(urlnorm.urlnorm('http://d/?ref=1&utm_x=1'), 'http://d/?ref=1')
+        self.assertEqual(urlnorm.urlnorm('http://a.shop.example/?ref=1&id=1&utm_x=1'),
+                         'http://a.shop.example/?id=1')
+        self.assertEqual(urlnorm.urlnorm('http://www.shop.example/?ref=1&id=1&x=1'),
+                         'http://www.shop.example/?id=1&ref=1')
+    def testInvalidatesCache(self):
+        urlnorm.enable_cache()
+        try:
+            self.assertEqual(urlnorm.urlnorm('http://d/?a'), 'http://d/?a')
+            urlnorm.set_query_filter(urlnorm.QueryFilter(['a']))
+            self.assertEqual(urlnorm.urlnorm('http://d/?a'), 'http://d/')
+        finally:
+            urlnorm.disable_cache()
+
 class TestPrePluginHook(unittest.TestCase):
     def _plugfn(self, url):
         return 'http://x/'
@@ -228,10 +1281,78 @@ class TestPostPluginHook(unittest.TestCase):
     def testPostPluginHook(self):
         self.assertEqual(urlnorm.urlnorm('http://d/p'), 'http://d/path')
 
+class TestPluginRegistry(unittest.TestCase):
+    def tearDown(self):
+        urlnorm._pre_plugins = []
+        urlnorm._post_plugins = []
+    def plugfn(self, path):
+        def plugfn(parts):
+            parts.path = path
+            return parts
+        return plugfn
+    def testUnregister(self):
+        a, b = self.plugfn('/a'), self.plugfn('/b')
+        urlnorm.register_post_plugin(a)
+        urlnorm.register_post_plugin(b)
+        urlnorm.unregister_post_plugin(b)
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://d/a')
+        urlnorm.unregister_post_plugin(a)
+        self.assertEqual(urlnorm.urlnorm('http://d/'), 'http://d/')
+        self.assertRaises(ValueError, urlnorm.unregister_post_plugin, a)
+        self.assertRaises(ValueError, urlnorm.unregister_pre_plugin, a)
+    def testReplace(self):
+        a, b, c = self.plugfn('/a'), self.plugfn('/b'), self.plugfn('/c')
+        urlnorm.register_post_plugin(a)
+        urlnorm.register_post_plugin(b)
+        urlnorm.replace_post_plugin(a, c)
+        self.assertEqual(urlnorm._post_plugins, (c, b))
+        urlnorm.register_pre_plugin(a)
+        urlnorm.replace_pre_plugin(a, b)
+        self.assertEqual(urlnorm._pre_plugins, (b,))
+    def testRebindingClearsCache(self):
+        urlnorm.enable_cache()
+        try:
+            urlnorm.register_post_plugin(self.plugfn('/a'))
+            self.assertEqual(urlnorm.urlnorm('http://d/p'), 'http://d/a')
+            urlnorm._post_plugins = []
+            self.assertEqual(urlnorm.urlnorm('http://d/p'), 'http://d/p')
+        finally:
+            urlnorm.disable_cache()
+    def testSnapshotsAreImmutable(self):
+        pipeline = urlnorm._current_pipeline()
+        urlnorm.register_pre_plugin(lambda url: 'http://x/')
+        self.assertEqual(len(pipeline.pre_source), 0)
+        self.assertEqual(urlnorm._current_pipeline().pre_source, urlnorm._pre_plugins)
+    def testConcurrentRegistration(self):
+        # Every URL is normalized either with or without the plugin,
+        # never with a pipeline that is half updated
+        a = self.plugfn('/a')
+        a.hosts = ['d']
+        stop = threading.Event()
+        def register():
+            while not stop.is_set():
+                urlnorm.register_post_plugin(a)
+                urlnorm.unregister_post_plugin(a)
+        results = set()
+        def normalize():
+            for i in range(200):
+                results.update(urlnorm.urlnorm_many(['http://D/p', 'http://e/p']))
+        threads = [threading.Thread(target=normalize) for i in range(4)]
+        registrar = threading.Thread(target=register)
+        registrar.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stop.set()
+        registrar.join()
+        self.assertTrue(results <= set(['http://d/p', 'http://d/a', 'http://e/p']))
+
 # Load all of the testcases into a single testsuite
 testsuite = unittest.TestSuite()
 testloader = unittest.TestLoader()
 testsuite.addTest(testloader.loadTestsFromTestCase(TestHostname))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestPercentEncoding))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestPath))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestScheme))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestPort))
@@ -239,8 +1360,31 @@ testsuite.addTest(testloader.loadTestsFromTestCase(TestQuery))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestNetlocSplit))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestURLParse))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestURLNorm))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestFastPath))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestURLNormMany))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestBytes))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestArrays))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestBaseResolver))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestCache))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestHostCache))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestDiskCache))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestFingerprint))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestDedupe))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestShards))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestParallel))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestService))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestUnixService))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestCommandLine))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestNormalizeFile))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestParsedURL))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestPluginDeclarations))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestPluginConfig))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestStartup))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestStats))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestQueryFilter))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestPrePluginHook))
 testsuite.addTest(testloader.loadTestsFromTestCase(TestPostPluginHook))
+testsuite.addTest(testloader.loadTestsFromTestCase(TestPluginRegistry))
 testresults = unittest.TextTestRunner(verbosity=1).run(testsuite)
 
 # Return 0 if successful, 1 if there was a failure
@@ -16,136 +16,2053 @@
 
 __author__ = "Kurt McKee <contactme@kurtmckee.org>"
 
+import collections
+import fnmatch
+import hashlib
+import io
+import itertools
+import json
+import math
+import os
 import re
-import urllib
+import sys
+import threading
+import time
+import types
+import unicodedata
 import urlparse
 
+# Modules that are only needed by the command line, the service, the
+# bulk file API and the worker pools (argparse, imp, mmap, multiprocessing,
+# Queue, socket, SocketServer) are imported where they are used, which
+# keeps `import urlnorm` quick for short-lived processes
+
 DEFAULT_PORTS = {
     'http': u'80',
     'https': u'443',
 }
 
-NETLOC = re.compile("""
-    ^
-    (?:
-        (?P<username>[^:@]+)?
-        (?:
-            :
-            (?P<password>[^@]*)
-        )?
-        @
-    )?
-    (?P<hostname>[^:]+)
-    (?:
-        :
-        (?P<port>[0-9]*)
-    )?
-    $
-    """, re.VERBOSE,
-)
+class _LazyPattern(object):
+    # A regular expression that is only compiled when it is first used.
+    # The methods of the compiled pattern are then stored on the instance,
+    # so later calls cost no more than calling the pattern directly
+    def __init__(self, pattern, flags=0):
+        self._args = (pattern, flags)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = getattr(re.compile(*self._args), name)
+        setattr(self, name, value)
+        return value
 
-PERCENT_ENCODING = re.compile("%([0-9a-f]{2})", re.IGNORECASE)
+PERCENT_ENCODING = _LazyPattern("%([0-9a-f]{2})", re.IGNORECASE)
+UNRESERVED = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.~'
 UNACCEPTABLE_QUERY_CHARS = re.compile("([^A-Za-z0-9_.~/-])")
 
 # http://www.pc-help.org/obscure.htm
 # http://www.securelist.com/en/blog/148/
 # Translate the IP address from octal, decimal, and hex
 # into a base 10 quadruple octet (like 127.0.0.1)
-NUMERIC_IP = re.compile("""
-    ^
-    (?:
-        (?P<o0>(?:[0-9]+)|(?:0x[0-9a-f]+))
-        [.]
-    )?
-    (?:
-        (?P<o1>(?:[0-9]+)|(?:0x[0-9a-f]+))
-        [.]
-    )?
-    (?:
-        (?P<o2>(?:[0-9]+)|(?:0x[0-9a-f]+))
-        [.]
-    )?
-    (?P<o3>(?:[0-9]+)|(?:0x[0-9a-f]+))
-    $
-    """, re.VERBOSE | re.IGNORECASE
-)
+HEXDIGITS = '0123456789abcdef'
+IPV6_CHARS = '0123456789abcdefABCDEF:.'
 
-_pre_plugins = []
-_post_plugins = []
+# The registered plugins are never modified in place: every change
+# publishes new tuples and a new _Pipeline built from them, so urlnorm()
+# always sees a consistent snapshot without taking a lock
+_pre_plugins = ()
+_post_plugins = ()
+# Incremented whenever the plugins change so that cached results
+# produced by a different set of plugins are never returned
+_plugin_version = 0
+# Held by everything that changes the plugins or builds a _Pipeline
+_registry_lock = threading.RLock()
 
 def register_pre_plugin(fn):
-    _pre_plugins.append(fn)
+    with _registry_lock:
+        _set_plugins(tuple(_pre_plugins) + (fn,), _post_plugins)
 def register_post_plugin(fn):
-    _post_plugins.append(fn)
+    with _registry_lock:
+        _set_plugins(_pre_plugins, tuple(_post_plugins) + (fn,))
+
+def unregister_pre_plugin(fn):
+    with _registry_lock:
+        _set_plugins(_replace_plugin(_pre_plugins, fn), _post_plugins)
+def unregister_post_plugin(fn):
+    with _registry_lock:
+        _set_plugins(_pre_plugins, _replace_plugin(_post_plugins, fn))
+
+def replace_pre_plugin(old, new):
+    with _registry_lock:
+        _set_plugins(_replace_plugin(_pre_plugins, old, new), _post_plugins)
+def replace_post_plugin(old, new):
+    with _registry_lock:
+        _set_plugins(_pre_plugins, _replace_plugin(_post_plugins, old, new))
+
+def _replace_plugin(plugins, old, new=None):
+    # Return `plugins` with `old` replaced by `new` in the same position,
+    # or removed if `new` is None
+    plugins = list(plugins)
+    try:
+        index = plugins.index(old)
+    except ValueError:
+        raise ValueError('plugin %s is not registered' % _plugin_name(old))
+    plugins[index:index + 1] = [] if new is None else [new]
+    return plugins
+
+def _set_plugins(pre_plugins, post_plugins):
+    global _pre_plugins, _post_plugins
+    with _registry_lock:
+        _pre_plugins = tuple(pre_plugins)
+        _post_plugins = tuple(post_plugins)
+        _plugins_changed()
+
+def _plugins_changed():
+    global _plugin_version
+    with _registry_lock:
+        _plugin_version += 1
+        _build_pipeline()
+    if _cache is not None:
+        _cache.clear()
+
+def load_plugins(config):
+    # Register the plugins and the query filter described by `config`,
+    # which is a dictionary or the path of a JSON file like
+    #
+    #   {"pre": ["msplinks"],
+    #    "post": [{"module": "nowww", "hosts": ["example.com"]}, "indexes"],
+    #    "query_filter": {"deny": ["utm_*"]}}
+    #
+    # A plugin is either the name of a plugin module, as accepted by
+    # _load_plugin(), or a dictionary with the "module", the "function"
+    # in it ("plugfn" by default) and the plugin's declarations. Plugin
+    # modules are only imported when the plugin is first called, so a
+    # plugin whose declarations never match is never imported.
+    if not isinstance(config, dict):
+        with open(config, 'rb') as f:
+            config = json.load(f)
+    plugins = {}
+    for kind in ('pre', 'post'):
+        plugins[kind] = []
+        for entry in config.get(kind, ()):
+            if not isinstance(entry, dict):
+                entry = {'module': entry}
+            _find_plugin_module(entry['module'])
+            plugins[kind].append(_LazyPlugin(**dict((str(k), v) for k, v in entry.items())))
+    # Publish all of the plugins at once
+    with _registry_lock:
+        _set_plugins(tuple(_pre_plugins) + tuple(plugins['pre']),
+                     tuple(_post_plugins) + tuple(plugins['post']))
+    if 'query_filter' in config:
+        rules = config['query_filter']
+        set_query_filter(None if rules is None else
+                         QueryFilter(**dict((str(k), v) for k, v in rules.items())))
+
+def freeze_plugins(path=None):
+    # Return the registered plugins and the query filter in the form that
+    # load_plugins() accepts, and write them to the JSON file `path` if it
+    # is given. The snapshot includes the declarations of every plugin
+    # that has been imported so far, so a process that loads it can skip
+    # the imports of plugins that do not apply to its URLs. Plugins that
+    # cannot be imported by name, like lambdas, raise ValueError.
+    pipeline = _current_pipeline()
+    config = {
+        'pre': [_freeze_plugin(fn) for fn in pipeline.pre_source],
+        'post': [_freeze_plugin(fn) for fn in pipeline.post_source],
+    }
+    if _query_filter is not None:
+        config['query_filter'] = _query_filter.config
+    if path is not None:
+        with open(path, 'wb') as f:
+            json.dump(config, f, indent=2, sort_keys=True)
+    return config
+
+_DECLARATIONS = ('substrings', 'hosts', 'path_pattern')
+
+def _freeze_plugin(fn):
+    if isinstance(fn, _LazyPlugin):
+        entry = {'module': fn.module, 'function': fn.function}
+    else:
+        module = getattr(fn, '__module__', None)
+        name = getattr(fn, '__name__', None)
+        if module in (None, '__main__') or module.startswith('urlnorm_plugin_') or \
+                getattr(sys.modules.get(module), name, None) is not fn:
+            raise ValueError('plugin %s cannot be imported by name' % _plugin_name(fn))
+        entry = {'module': module, 'function': name}
+    for name in _DECLARATIONS:
+        value = getattr(fn, name, None)
+        if value is not None:
+            if name == 'path_pattern':
+                entry[name] = getattr(value, 'pattern', value)
+            else:
+                entry[name] = list(value)
+    return entry
+
+class _LazyPlugin(object):
+    # Stands in for a plugin function that is imported from its module
+    # the first time the plugin is called. Once it is imported, its own
+    # declarations are used for any that were not given here
+    def __init__(self, module, function='plugfn', **declarations):
+        for name in declarations:
+            if name not in _DECLARATIONS:
+                raise TypeError('unknown plugin declaration %r' % name)
+        self.__dict__.update(declarations)
+        self.module = module
+        self.function = function
+        self.fn = None
+        self.__name__ = function
+        self.__module__ = module
+
+    def __call__(self, arg):
+        fn = self.fn
+        if fn is None:
+            fn = self._load()
+        return fn(arg)
+
+    def _load(self):
+        # Threads that call the plugin at the same time import it once
+        with _registry_lock:
+            if self.fn is not None:
+                return self.fn
+            fn = getattr(_load_plugin_module(self.module), self.function)
+            adopted = False
+            for name in _DECLARATIONS:
+                if name not in self.__dict__ and getattr(fn, name, None) is not None:
+                    setattr(self, name, getattr(fn, name))
+                    adopted = True
+            self.fn = fn
+            if adopted:
+                # Rebuild the pipeline with the new declarations
+                _plugins_changed()
+            return fn
+
+    def __getstate__(self):
+        # Worker processes import the plugin themselves if they need it
+        state = self.__dict__.copy()
+        state['fn'] = None
+        return state
+
+def _load_plugin(name):
+    return _load_plugin_module(name).plugfn
+
+def _load_plugin_module(name):
+    # `name` may be one of the plugins shipped in the plugins/ directory,
+    # the path to a plugin file, or the name of an importable module
+    import imp
+    path = _plugin_path(name)
+    if path is not None:
+        module_name = os.path.splitext(os.path.basename(path))[0]
+        return imp.load_source('urlnorm_plugin_%s' % module_name, path)
+    return __import__(name, fromlist=['plugfn'])
+
+def _find_plugin_module(name):
+    # Raise ImportError if the plugin module `name` cannot be found,
+    # without importing it. Only the top-level package of a dotted name
+    # is looked up, since finding the rest would import the package
+    import imp
+    if _plugin_path(name) is None and name.split('.')[0] not in sys.modules:
+        f = imp.find_module(name.split('.')[0])[0]
+        if f is not None:
+            f.close()
+
+def _plugin_path(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'plugins', '%s.py' % name)
+    if os.path.isfile(path):
+        return path
+    elif os.path.isfile(name):
+        return name
+    return None
+
+# Plugins may declare when they can apply so that they can be skipped for
+# URLs they would not change:
+#
+#   pre plugins:  fn.substrings - the URL must contain one of these strings
+#   post plugins: fn.hosts - the hostname must be or end with one of these
+#                 domains, like 'example.com' for 'www.example.com'
+#                 fn.path_pattern - a regular expression the path must match
+#
+# Plugins without declarations are called for every URL. The declarations
+# of all plugins are compiled into a single _Pipeline.
+class _Pipeline(object):
+    def __init__(self, pre_plugins, post_plugins, version, stats=None,
+                 query_filter=None):
+        self.pre_source = pre_plugins
+        self.post_source = post_plugins
+        self.version = version
+        self.stats = stats
+        self.query_filter = query_filter
+        # Canonical URLs can only be returned unchanged if nothing but
+        # the built-in normalization would be applied to them
+        self.fast_path = not pre_plugins and not post_plugins and query_filter is None
+
+        self.pre = []
+        self.pre_undeclared = []
+        # If an undeclared plugin runs before a declared one, it may make
+        # the declared one apply, so the declarations cannot be checked
+        # up front and every plugin's declarations are checked in turn
+        self.pre_interleaved = False
+        substrings = set()
+        for fn in pre_plugins:
+            fn_substrings = getattr(fn, 'substrings', None)
+            if stats is not None:
+                fn = _timed(stats, 'pre_plugin:%s' % _plugin_name(fn), fn)
+            if fn_substrings is None:
+                self.pre_undeclared.append(fn)
+            else:
+                if self.pre_undeclared:
+                    self.pre_interleaved = True
+                fn_substrings = tuple(fn_substrings)
+                substrings.update(fn_substrings)
+            self.pre.append((fn, fn_substrings))
+        self.pre_filter = None
+        if substrings:
+            self.pre_filter = re.compile('|'.join(
+                re.escape(i) for i in sorted(substrings, key=len, reverse=True)))
+
+        self.post = []
+        self.post_undeclared = []
+        self.post_interleaved = False
+        self.post_hosts = set()
+        path_patterns = []
+        for fn in post_plugins:
+            hosts = getattr(fn, 'hosts', None)
+            path_pattern = getattr(fn, 'path_pattern', None)
+            if stats is not None:
+                fn = _timed(stats, 'post_plugin:%s' % _plugin_name(fn), fn)
+            if hosts is None and path_pattern is None:
+                self.post_undeclared.append(fn)
+            elif self.post_undeclared:
+                self.post_interleaved = True
+            if hosts is not None:
+                hosts = frozenset(h.lower().strip('.') for h in hosts)
+                self.post_hosts.update(hosts)
+            if path_pattern is not None:
+                path_patterns.append(path_pattern)
+                path_pattern = re.compile(path_pattern)
+            self.post.append((fn, hosts, path_pattern))
+        # Path patterns are combined into one regex where that cannot
+        # change what they match; host declarations are looked up by
+        # domain suffix
+        self.post_paths = ()
+        combinable = [p for p in path_patterns if _is_combinable(p)]
+        if combinable:
+            self.post_paths += (re.compile('|'.join('(?:%s)' % p for p in combinable)),)
+        self.post_paths += tuple(re.compile(p) for p in path_patterns if p not in combinable)
+
+    def run_pre(self, url):
+        if self.pre_interleaved or \
+            (self.pre_filter is not None and self.pre_filter.search(url)):
+            for fn, substrings in self.pre:
+                if substrings is None or any(i in url for i in substrings):
+                    url = fn(url)
+        else:
+            for fn in self.pre_undeclared:
+                url = fn(url)
+        return url
+
+    def run_post(self, parts):
+        if self.post_interleaved or self._post_candidates(parts):
+            for fn, hosts, path_pattern in self.post:
+                if hosts is not None and not _host_in(parts.hostname, hosts):
+                    continue
+                if path_pattern is not None and not path_pattern.search(parts.path):
+                    continue
+                parts = _call_post_plugin(fn, parts)
+        else:
+            for fn in self.post_undeclared:
+                parts = _call_post_plugin(fn, parts)
+        return parts
+
+    def _post_candidates(self, parts):
+        # Return True if any declared plugin might apply to `parts`
+        for pattern in self.post_paths:
+            if pattern.search(parts.path):
+                return True
+        return bool(self.post_hosts) and _host_in(parts.hostname, self.post_hosts)
+
+def _is_combinable(pattern):
+    # Return True if `pattern` can be joined with others by '|': it has
+    # no groups, whose numbers would shift (and without which it cannot
+    # have backreferences), and no inline flags, which would apply to
+    # the other patterns as well
+    import sre_parse
+    parsed = sre_parse.parse(pattern)
+    return not parsed.pattern.flags and parsed.pattern.groups == 1
+
+def _host_in(hostname, domains):
+    # Return True if `hostname` is one of `domains` or a subdomain of one
+    while hostname:
+        if hostname in domains:
+            return True
+        hostname = hostname.partition('.')[2]
+    return False
+
+def _call_post_plugin(fn, parts):
+    ret = fn(parts)
+    # Plugins that modify `parts` in place and return it need no update
+    if ret is not parts:
+        parts.update(ret)
+    return parts
+
+_pipeline = _Pipeline(_pre_plugins, _post_plugins, _plugin_version)
+
+def _current_pipeline():
+    pipeline = _pipeline
+    if not _is_current(pipeline):
+        # The plugin lists were rebound directly, stats were enabled,
+        # or another thread is publishing new plugins right now
+        with _registry_lock:
+            pipeline = _pipeline
+            if pipeline.pre_source is not _pre_plugins or \
+                pipeline.post_source is not _post_plugins:
+                # Treat rebinding like any other change, so that cached
+                # results of the old plugins are not returned
+                _plugins_changed()
+                pipeline = _pipeline
+            elif not _is_current(pipeline):
+                pipeline = _build_pipeline()
+    return pipeline
+
+def _is_current(pipeline):
+    return pipeline.pre_source is _pre_plugins and \
+        pipeline.post_source is _post_plugins and \
+        pipeline.version == _plugin_version and \
+        pipeline.stats is _stats
+
+def _build_pipeline():
+    # Must be called with _registry_lock held
+    global _pipeline
+    _pipeline = _Pipeline(_pre_plugins, _post_plugins, _plugin_version,
+                          _stats, _query_filter)
+    return _pipeline
+
+class QueryFilter(object):
+    # Removes query parameters by name. `deny` and `allow` are lists of
+    # rules, each of which is a parameter name, a prefix like 'utm_*', or
+    # a glob pattern like 'sess*id'. A parameter is removed if it matches
+    # a `deny` rule, or if `allow` is given and it matches no `allow` rule.
+    # `hosts` maps domains to dictionaries with additional `deny` and
+    # `allow` rules for that domain and its subdomains; when several
+    # domains match a hostname, the most specific one is used
+    def __init__(self, deny=(), allow=None, hosts=None):
+        # The arguments, as freeze_plugins() records them
+        self.config = {'deny': list(deny), 'allow': None if allow is None else list(allow),
+                       'hosts': hosts or {}}
+        default = _QueryRules(deny, allow)
+        self._keep = {None: _QueryKeep([default])}
+        for domain, rules in (hosts or {}).items():
+            self._keep[domain.lower().strip('.')] = _QueryKeep([default, _QueryRules(**rules)])
+
+    def keep_function(self, hostname):
+        # Return a function that returns True for the names of the
+        # query parameters that should be kept for `hostname`
+        keep = self._keep
+        while hostname:
+            fn = keep.get(hostname)
+            if fn is not None:
+                return fn
+            hostname = hostname.partition('.')[2]
+        return keep[None]
+
+class _QueryRules(object):
+    def __init__(self, deny=(), allow=None):
+        self.deny = _NameMatcher(deny)
+        self.allow = None
+        if allow is not None:
+            self.allow = _NameMatcher(allow)
+
+    def keep(self, name):
+        return name not in self.deny and (self.allow is None or name in self.allow)
+
+class _NameMatcher(object):
+    def __init__(self, rules):
+        names = set()
+        prefixes = []
+        patterns = []
+        for rule in rules:
+            if not any(c in rule for c in '*?['):
+                names.add(rule)
+            elif rule.endswith('*') and not any(c in rule[:-1] for c in '*?['):
+                prefixes.append(rule[:-1])
+            else:
+                patterns.append(fnmatch.translate(rule))
+        self.names = frozenset(names)
+        self.prefixes = tuple(prefixes)
+        self.pattern = None
+        if patterns:
+            self.pattern = re.compile('|'.join('(?:%s)' % p for p in patterns))
+
+    def __contains__(self, name):
+        return name in self.names or \
+            (bool(self.prefixes) and name.startswith(self.prefixes)) or \
+            (self.pattern is not None and self.pattern.match(name) is not None)
+
+class _QueryKeep(object):
+    # The same parameter names occur over and over, so the decisions
+    # are remembered (up to a limit)
+    def __init__(self, rule_sets):
+        self.rule_sets = rule_sets
+        self.decisions = {}
+
+    def __call__(self, name):
+        try:
+            return self.decisions[name]
+        except KeyError:
+            pass
+        keep = all(rules.keep(name) for rules in self.rule_sets)
+        if len(self.decisions) < 10000:
+            self.decisions[name] = keep
+        return keep
+
+_query_filter = None
+
+def set_query_filter(query_filter):
+    # Install a QueryFilter, or remove it by passing None
+    global _query_filter
+    _query_filter = query_filter
+    _plugins_changed()
+
+class _Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = [0, 0.0]
+            counter[0] += 1
+            counter[1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return dict((name, {'calls': c[0], 'seconds': c[1]})
+                        for name, c in self._counters.items())
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+
+# The stages of urlnorm() that are timed when statistics are enabled,
+# mapped to the names that they are reported under. While enabled, these
+# module-level functions are replaced by timing wrappers, so statistics
+# cost nothing while they are disabled
+_STAGES = {
+    '_urlnorm': 'urlnorm',
+    '_resolve_relative': 'urlnorm',
+    '_normalize_percent_encoding': 'percent_encoding',
+    '_urlparse': 'urlparse',
+    '_cached_normalize_netloc': 'netloc',
+    '_normalize_path': 'path',
+    '_split_query': 'split_query',
+    '_join_parts': 'join',
+}
+_stats = None
+_stats_lock = threading.Lock()
+_unwrapped_stages = {}
+
+def enable_stats():
+    global _stats
+    with _stats_lock:
+        if _stats is not None:
+            return
+        stats = _Stats()
+        module = globals()
+        for name in _STAGES:
+            _unwrapped_stages[name] = module[name]
+            module[name] = _timed(stats, _STAGES[name], module[name])
+        _stats = stats
+def disable_stats():
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            return
+        globals().update(_unwrapped_stages)
+        _unwrapped_stages.clear()
+        _stats = None
+def stats():
+    # Return {name: {'calls': int, 'seconds': float}} for each stage and
+    # plugin that has run since statistics were enabled or reset
+    if _stats is None:
+        return None
+    return _stats.snapshot()
+def reset_stats():
+    if _stats is not None:
+        _stats.reset()
+
+def _timed(stats, name, fn):
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats.add(name, time.time() - start)
+    return timed
+
+def _plugin_name(fn):
+    return '%s.%s' % (getattr(fn, '__module__', None),
+                      getattr(fn, '__name__', fn.__class__.__name__))
+
+class _LRUCache(object):
+    # A bounded cache that approximates least-recently-used eviction with
+    # the CLOCK algorithm. Lookups take no lock: a hit only sets the
+    # entry's referenced flag, and the counters are itertools.count()
+    # objects, whose next() is atomic. Inserts and evictions take the
+    # lock; an entry that was referenced since it was last passed over
+    # gets a second chance instead of being evicted
+    def __init__(self, maxsize=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # Entries are [value, size, referenced]
+            self._data = collections.OrderedDict()
+            self.bytes = 0
+            self._hits = itertools.count()
+            self._misses = itertools.count()
+            self.evictions = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            next(self._misses)
+            return None
+        entry[2] = True
+        next(self._hits)
+        return entry[0]
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            data = self._data
+            old = data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            data[key] = [value, size, False]
+            self.bytes += size
+            while data and (
+                (self.maxsize is not None and len(data) > self.maxsize) or
+                (self.maxbytes is not None and self.bytes > self.maxbytes)
+            ):
+                oldest, entry = data.popitem(last=False)
+                if entry[2] and oldest != key:
+                    entry[2] = False
+                    data[oldest] = entry
+                    continue
+                self.bytes -= entry[1]
+                self.evictions += 1
+
+    def info(self):
+        with self._lock:
+            return {
+                'hits': _count_value(self._hits),
+                'misses': _count_value(self._misses),
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'bytes': self.bytes,
+                'maxsize': self.maxsize,
+                'maxbytes': self.maxbytes,
+            }
+
+def _count_value(counter):
+    # The next number an itertools.count() would return
+    return counter.__reduce__()[1][0]
+
+_cache = None
+
+def enable_cache(maxsize=10000, maxbytes=None):
+    global _cache
+    _cache = _LRUCache(maxsize, maxbytes)
+def disable_cache():
+    global _cache
+    _cache = None
+def clear_cache():
+    if _cache is not None:
+        _cache.clear()
+def cache_info():
+    if _cache is None:
+        return None
+    return _cache.info()
+
+# Normalized netlocs, keyed on (netloc, scheme). Hosts repeat far more
+# often than whole URLs do, so this is enabled by default
+_host_cache = _LRUCache(4096)
+
+def enable_host_cache(maxsize=4096):
+    global _host_cache
+    _host_cache = _LRUCache(maxsize)
+def disable_host_cache():
+    global _host_cache
+    _host_cache = None
+def host_cache_info():
+    if _host_cache is None:
+        return None
+    return _host_cache.info()
+
+class _DiskCache(object):
+    # Normalized URLs kept in an SQLite database, so that they outlive the
+    # process and are shared by every process that opens the same file.
+    # Rows are keyed on a digest of the URL, the base URL and the
+    # fingerprint of the code and plugins that produced them. The database
+    # is in WAL mode, so readers never wait for each other or for a writer.
+    # New results are written in batches; rows that are read are marked as
+    # used at most once per `touch_interval` seconds, and the least
+    # recently used rows are deleted when there are more than `maxsize`
+    def __init__(self, path, maxsize=1000000, timeout=30, flush_size=1000,
+                 touch_interval=3600):
+        self.path = path
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.flush_size = flush_size
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+        self._digest = (None, None)
+        # Digests mapped to (normalized URL, last used) for the rows read
+        # by warm() and the results that are not written yet
+        self._memory = {}
+        self._pending = {}
+        self._touched = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        return {'path': self.path, 'maxsize': self.maxsize, 'timeout': self.timeout,
+                'flush_size': self.flush_size, 'touch_interval': self.touch_interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        # A forked child must not use its parent's connection
+        if self._pid != os.getpid():
+            import sqlite3
+            db = sqlite3.connect(self.path, self.timeout, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS urls (key BLOB PRIMARY KEY, '
+                       'url NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID')
+            db.execute('CREATE INDEX IF NOT EXISTS urls_used ON urls (used)')
+            self._db = db
+            self._pid = os.getpid()
+            self._pending = {}
+            self._touched = set()
+        return self._db
+
+    def fingerprint(self, pipeline):
+        # The fingerprint of `pipeline`, or None if its results must not
+        # be stored because its plugins cannot be identified
+        if self._digest[0] is not pipeline:
+            self._digest = (pipeline, _pipeline_fingerprint(pipeline))
+        return self._digest[1]
+
+    def _keys(self, pipeline, base, urls):
+        prefix = self.fingerprint(pipeline)
+        if base is None:
+            prefix += '\1'
+        else:
+            prefix += '\0' + (base.encode('utf-8') if isinstance(base, unicode) else base)
+        keys = {}
+        for url in urls:
+            data = url.encode('utf-8') if isinstance(url, unicode) else url
+            keys[hashlib.md5(prefix + '\0' + data).digest()] = url
+        return keys
+
+    def get_many(self, pipeline, base, urls):
+        # Return a dictionary of the URLs that are in the cache
+        if not urls:
+            return {}
+        with self._lock:
+            db = self._connect()
+            keys = self._keys(pipeline, base, urls)
+            now = int(time.time())
+            stale = now - self.touch_interval
+            found = {}
+            missing = []
+            for key, url in keys.iteritems():
+                entry = self._pending.get(key) or self._memory.get(key)
+                if entry is None:
+                    missing.append(buffer(key))
+                    continue
+                found[url] = entry[0]
+                if entry[1] < stale:
+                    self._touched.add(key)
+                    self._memory[key] = (entry[0], now)
+            # Stay below SQLite's limit on the number of parameters
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = db.execute('SELECT key, url, used FROM urls WHERE key IN (%s)'
+                                  % ','.join('?' * len(chunk)), chunk)
+                for key, newurl, used in rows:
+                    key = str(key)
+                    # str results are stored as blobs and unicode as text
+                    found[keys[key]] = str(newurl) if isinstance(newurl, buffer) else newurl
+                    if used < stale:
+                        self._touched.add(key)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            return found
+
+    def set_many(self, pipeline, base, items):
+        # Store (URL, normalized URL) pairs, and write them out together
+        # with the used marks once there are `flush_size` of them
+        if not items and len(self._pending) + len(self._touched) < self.flush_size:
+            return
+        with self._lock:
+            self._connect()
+            if items:
+                keys = self._keys(pipeline, base, [url for url, newurl in items])
+                results = dict(items)
+                now = int(time.time())
+                for key, url in keys.iteritems():
+                    self._pending[key] = (results[url], now)
+            if len(self._pending) + len(self._touched) >= self.flush_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._pending or self._touched:
+                self._connect()
+                self._flush()
+
+    def _flush(self):
+        now = int(time.time())
+        pending = self._pending
+        touched = self._touched
+        self._pending = {}
+        self._touched = set()
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)',
+                           ((buffer(key), buffer(newurl) if isinstance(newurl, str) else newurl,
+                             used) for key, (newurl, used) in pending.iteritems()))
+            db.executemany('UPDATE urls SET used = ? WHERE key = ?',
+                           ((now, buffer(key)) for key in touched))
+            if self.maxsize is not None:
+                excess = db.execute('SELECT count(*) FROM urls').fetchone()[0] - self.maxsize
+                if excess > 0:
+                    db.execute('DELETE FROM urls WHERE key IN '
+                               '(SELECT key FROM urls ORDER BY used LIMIT ?)', (excess,))
+                    self.evictions += excess
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def warm(self, size):
+        # Read the `size` most recently used rows into memory
+        with self._lock:
+            db = self._connect()
+            rows = db.execute('SELECT key, url, used FROM urls ORDER BY used DESC LIMIT ?',
+                              (size,))
+            for key, newurl, used in rows:
+                self._memory[str(key)] = (str(newurl) if isinstance(newurl, buffer) else newurl,
+                                          used)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+            self._pid = None
+
+    def info(self):
+        with self._lock:
+            db = self._connect()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': db.execute('SELECT count(*) FROM urls').fetchone()[0],
+                'warm': len(self._memory),
+                'pending': len(self._pending),
+                'maxsize': self.maxsize,
+                'path': self.path,
+            }
+
+def _pipeline_fingerprint(pipeline):
+    # Identify the code that produces the results of `pipeline`: this
+    # module, the plugins and the query filter. Plugin declarations are
+    # left out, since they cannot change the results. Returns None if a
+    # plugin cannot be identified across processes and runs
+    global _source_digest
+    if _source_digest is None:
+        _source_digest = _file_digest(__file__)
+    h = hashlib.md5(_source_digest)
+    for kind, plugins in (('pre', pipeline.pre_source), ('post', pipeline.post_source)):
+        for fn in plugins:
+            fingerprint = _plugin_fingerprint(fn)
+            if fingerprint is None:
+                return None
+            h.update('%s\0%s\0' % (kind, fingerprint))
+    if pipeline.query_filter is not None:
+        h.update(json.dumps(pipeline.query_filter.config, sort_keys=True))
+    return h.digest()
+
+def _plugin_fingerprint(fn):
+    # Plugins are identified by the source file of their module, which
+    # covers module-level settings, and, for functions, by their code,
+    # default arguments and closure cells. Lambdas, methods and other
+    # callables are not identified, and neither are functions whose
+    # defaults or cells hold anything but plain immutable values
+    if isinstance(fn, _LazyPlugin):
+        digest = _file_digest(_module_file(fn.module))
+        return digest and '%s\0%s\0%s' % (fn.module, fn.function, digest)
+    if not isinstance(fn, types.FunctionType) or fn.__name__ == '<lambda>':
+        return None
+    digest = _file_digest(getattr(sys.modules.get(fn.__module__), '__file__', None))
+    if digest is None:
+        return None
+    parts = [fn.__module__, fn.__name__, digest, _code_fingerprint(fn.__code__)]
+    try:
+        values = [cell.cell_contents for cell in fn.__closure__ or ()]
+    except ValueError:
+        # An empty cell
+        return None
+    for value in list(fn.__defaults__ or ()) + values:
+        value = _value_fingerprint(value)
+        if value is None:
+            return None
+        parts.append(value)
+    return '\0'.join(parts)
+
+def _code_fingerprint(code):
+    # repr() of a nested code object contains its address, so those are
+    # replaced with their own fingerprints
+    consts = [_code_fingerprint(c) if isinstance(c, types.CodeType) else repr(c)
+              for c in code.co_consts]
+    return '%s\0%r\0%s' % (code.co_code, code.co_names, '\0'.join(consts))
+
+_PLAIN_TYPES = (str, unicode, int, long, float, bool, type(None))
+
+def _value_fingerprint(value):
+    if isinstance(value, _PLAIN_TYPES):
+        return '%s:%r' % (type(value).__name__, value)
+    elif isinstance(value, (tuple, frozenset)):
+        items = [_value_fingerprint(i) for i in value]
+        if None in items:
+            return None
+        if isinstance(value, frozenset):
+            items.sort()
+        return '%s(%s)' % (type(value).__name__, ','.join(items))
+    return None
+
+def _module_file(name):
+    # The file of module `name`, found without importing it
+    module = sys.modules.get(name)
+    if module is not None:
+        return getattr(module, '__file__', None)
+    path = _plugin_path(name)
+    if path is None:
+        import imp
+        try:
+            for part in name.split('.'):
+                f, path, description = imp.find_module(part, path and [path])
+                if f is not None:
+                    f.close()
+        except ImportError:
+            return None
+    return path
+
+def _file_digest(path):
+    if path is None:
+        return None
+    if os.path.isdir(path):
+        path = os.path.join(path, '__init__.py')
+    elif path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+        path = path[:-1]
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).digest()
+    except IOError:
+        return None
+
+_source_digest = None
+_disk_cache = None
+_flush_at_exit = False
+
+def enable_disk_cache(path, maxsize=1000000, warm=100000):
+    # Keep normalized URLs in the SQLite database `path`, which can be
+    # shared by any number of processes, and read the `warm` most recently
+    # used of them into memory right away
+    import atexit
+    global _disk_cache, _flush_at_exit
+    disable_disk_cache()
+    cache = _DiskCache(path, maxsize)
+    if warm:
+        cache.warm(warm)
+    _disk_cache = cache
+    if not _flush_at_exit:
+        # One handler flushes whichever cache is enabled at exit
+        atexit.register(flush_disk_cache)
+        _flush_at_exit = True
+def disable_disk_cache():
+    global _disk_cache
+    cache, _disk_cache = _disk_cache, None
+    if cache is not None:
+        cache.close()
+def flush_disk_cache():
+    if _disk_cache is not None:
+        _disk_cache.flush()
+def disk_cache_info():
+    if _disk_cache is None:
+        return None
+    return _disk_cache.info()
 
 def urlnorm(url, base=None):
+    if base is not None:
+        base = base.strip()
+    pipeline = _current_pipeline()
+    cache = _cache
+    if cache is None:
+        if _disk_cache is None:
+            return _urlnorm(url, base, pipeline, None)
+        return _urlnorm_stored(url, base, pipeline)
+    key = (url, base, pipeline.version)
+    newurl = cache.get(key)
+    if newurl is None:
+        newurl = _urlnorm_stored(url, base, pipeline)
+        cache.set(key, newurl, len(url) + len(base or '') + len(newurl))
+    return newurl
+
+def _urlnorm_stored(url, base, pipeline):
+    # _urlnorm(), looked up in and added to the disk cache if it is enabled
+    disk = _disk_cache
+    if disk is None or disk.fingerprint(pipeline) is None or \
+        (pipeline.fast_path and base is None and _is_canonical(url)):
+        return _urlnorm(url, base, pipeline, None)
+    newurl = disk.get_many(pipeline, base, [url]).get(url)
+    if newurl is None:
+        newurl = _urlnorm(url, base, pipeline, None)
+        disk.set_many(pipeline, base, [(url, newurl)])
+    return newurl
+
+def urlnorm_many(urls, base=None):
+    # The plugin pipeline, the caches and whether the fast path applies
+    # are looked up once for the whole batch. The URLs in the batch share
+    # the netlocs and paths that were already normalized, and the results
+    # of URLs that occur more than once
+    pipeline = _current_pipeline()
+    if base is not None:
+        base = base.strip()
+    fast = pipeline.fast_path and base is None
+    version = pipeline.version
+    netlocs = {}
+    paths = {}
+    results = {}
+    cache = _cache
+    disk = _disk_cache
+    if disk is not None and disk.fingerprint(pipeline) is None:
+        # The results of these plugins cannot be told apart from those
+        # of other plugins in other processes, so they are not stored
+        disk = None
+    if disk is not None:
+        # Only the URLs that are not in the memory cache are looked up on
+        # disk. Canonical URLs are cheaper to check than to look up
+        urls = list(urls)
+        lookup = set()
+        for url in urls:
+            if url in results or url in lookup or (fast and _is_canonical(url)):
+                continue
+            if cache is not None:
+                newurl = cache.get((url, base, version))
+                if newurl is not None:
+                    results[url] = newurl
+                    continue
+            lookup.add(url)
+        found = disk.get_many(pipeline, base, lookup)
+        if cache is not None:
+            for url, newurl in found.iteritems():
+                cache.set((url, base, version), newurl,
+                          len(url) + len(base or '') + len(newurl))
+        results.update(found)
+        new = []
+    ret = []
+    for url in urls:
+        newurl = results.get(url)
+        if newurl is None:
+            if fast and _is_canonical(url):
+                next(_fast_path_taken)
+                results[url] = url
+                ret.append(url)
+                continue
+            if cache is not None and disk is None:
+                newurl = cache.get((url, base, version))
+            if newurl is None:
+                # The fast path was already checked above
+                newurl = _urlnorm(url, base, pipeline, netlocs, paths=paths,
+                                  fast=False)
+                if fast:
+                    next(_fast_path_missed)
+                if cache is not None:
+                    cache.set((url, base, version), newurl,
+                              len(url) + len(base or '') + len(newurl))
+                if disk is not None and url in lookup:
+                    new.append((url, newurl))
+            results[url] = newurl
+        ret.append(newurl)
+    if disk is not None:
+        disk.set_many(pipeline, base, new)
+    return ret
+
+def urlnorm_bytes(url, base=None):
+    # Normalize a URL given as a str, bytearray or memoryview of UTF-8
+    # bytes and return a str. The result is the same as decoding the URL,
+    # calling urlnorm() and encoding the result, but ASCII URLs, which are
+    # the vast majority, are normalized as byte strings without ever
+    # being decoded
+    return urlnorm_bytes_many([url], base)[0]
+
+def urlnorm_bytes_many(urls, base=None):
+    if base is not None:
+        base = _as_bytes(base)
+        if _NON_ASCII.search(base) is not None:
+            return [urlnorm(_as_bytes(url).decode('utf-8'), base.decode('utf-8')).encode('utf-8')
+                    for url in urls]
+    urls = [_as_bytes(url) for url in urls]
+    ascii = [_NON_ASCII.search(url) is None for url in urls]
+    results = iter(urlnorm_many([url for url, a in zip(urls, ascii) if a], base))
+    ret = []
+    for url, a in zip(urls, ascii):
+        if a:
+            newurl = results.next()
+        else:
+            newurl = urlnorm(url.decode('utf-8'), base)
+        if isinstance(newurl, unicode):
+            # A plugin or the result cache may return unicode
+            newurl = newurl.encode('utf-8')
+        ret.append(newurl)
+    return ret
+
+_NON_ASCII = _LazyPattern('[\x80-\xff]')
+
+def _as_bytes(data):
+    if isinstance(data, str):
+        return data
+    elif isinstance(data, memoryview):
+        return data.tobytes()
+    elif isinstance(data, bytearray):
+        return str(data)
+    raise TypeError('expected a str, bytearray or memoryview, not %s' % type(data).__name__)
+
+def urlnorm_array(values, base=None):
+    # Normalize a column of URLs given as a pyarrow string or binary array
+    # (or chunked array), or as a NumPy array of str, unicode or objects,
+    # and return an array of the same kind and shape. Nulls, including
+    # None and NaN in object arrays, are kept, and each distinct URL is
+    # only normalized once. Arrow arrays are read straight from their
+    # offset and data buffers. pyarrow and NumPy are only imported here
+    kind = type(values).__module__.split('.')[0]
+    if kind == 'pyarrow':
+        return _urlnorm_arrow(values, base)
+    elif kind == 'numpy':
+        return _urlnorm_numpy(values, base)
+    raise TypeError('expected a pyarrow or NumPy array, not %s' % type(values).__name__)
+
+def _urlnorm_arrow(values, base):
+    import numpy
+    import pyarrow
+    if isinstance(values, pyarrow.ChunkedArray):
+        return pyarrow.chunked_array([_urlnorm_arrow(chunk, base) for chunk in values.chunks],
+                                     type=values.type)
+    if pyarrow.types.is_string(values.type) or pyarrow.types.is_binary(values.type):
+        offset_type = numpy.dtype(numpy.int32)
+    elif pyarrow.types.is_large_string(values.type) or pyarrow.types.is_large_binary(values.type):
+        offset_type = numpy.dtype(numpy.int64)
+    else:
+        raise TypeError('expected a string or binary array, not %s' % values.type)
+    validity, offsets, data = values.buffers()
+    offsets = numpy.frombuffer(offsets, dtype=offset_type, count=len(values) + 1,
+                               offset=values.offset * offset_type.itemsize).tolist()
+    data = '' if data is None else data.to_pybytes()
+    if validity is not None:
+        validity = validity.to_pybytes()
+    results = _normalize_buffers(data, offsets, validity, values.offset, base)
+    return pyarrow.array(results, type=values.type)
+
+def _normalize_buffers(data, offsets, validity, start, base):
+    # Normalize the values of an Arrow string or binary array, given its
+    # data buffer, its `offsets` (one more than there are values), and
+    # its validity bitmap, in which the bit of the first value is `start`
+    values = []
+    for i in xrange(len(offsets) - 1):
+        bit = start + i
+        if validity is not None and not ord(validity[bit >> 3]) & (1 << (bit & 7)):
+            values.append(None)
+        else:
+            values.append(data[offsets[i]:offsets[i+1]])
+    return _normalize_column(values, base, urlnorm_bytes_many)
+
+def _urlnorm_numpy(values, base):
+    import numpy
+    items = values.ravel().tolist()
+    if values.dtype.kind == 'S':
+        return numpy.array(_normalize_column(items, base, urlnorm_bytes_many),
+                           dtype='S').reshape(values.shape)
+    elif values.dtype.kind == 'U':
+        return numpy.array(_normalize_column(items, base, urlnorm_many),
+                           dtype='U').reshape(values.shape)
+    elif values.dtype.kind != 'O':
+        raise TypeError('expected an array of strings or objects, not %s' % values.dtype)
+    # None and NaN are nulls in object arrays
+    keys = [None if item is None or item != item else item for item in items]
+    results = _normalize_column(keys, base, urlnorm_many)
+    for i, key in enumerate(keys):
+        if key is None:
+            results[i] = items[i]
+    ret = numpy.empty(len(results), dtype=object)
+    ret[:] = results
+    return ret.reshape(values.shape)
+
+def _normalize_column(values, base, normalize_many):
+    # Normalize each distinct value once; None stays None
+    unique = dict.fromkeys(values)
+    unique.pop(None, None)
+    keys = list(unique)
+    unique.update(zip(keys, normalize_many(keys, base)))
+    return [None if value is None else unique[value] for value in values]
+
+class BaseResolver(object):
+    # Resolves and normalizes many links found in one document against the
+    # document's URL. The base URL is parsed, and its netloc normalized,
+    # only once; relative references are then merged into its path
+    # directly, the way urlparse.urljoin() would merge them, instead of
+    # being joined into a string and parsed again. References that are
+    # absolute or network-path references, and bases that are not http or
+    # https URLs with a netloc, are handed to urlnorm() unchanged, as are
+    # all references while "pre" plugins are registered, since those must
+    # see the joined URL.
+    def __init__(self, base):
+        self.base = base.strip()
+        self.scheme = None
+        try:
+            scheme, netloc, path, params, query, fragment = urlparse.urlparse(self.base)
+            if scheme in ('http', 'https') and netloc:
+                netloc = _normalize_percent_encoding(netloc)
+                _split_hierarchy('//' + netloc)
+                self.scheme = scheme
+                self.netloc = netloc
+                self.normalized_netloc = _cached_normalize_netloc((netloc, scheme))
+                self.path = path
+                self.params = params
+                self.query = query
+                self.directory = path.split('/')[:-1]
+        except ValueError:
+            # urlnorm() will raise the same error for every reference
+            self.scheme = None
+
+    def resolve(self, href):
+        return self.resolve_many([href])[0]
+
+    def resolve_many(self, hrefs):
+        pipeline = _current_pipeline()
+        netlocs = {}
+        results = {}
+        ret = []
+        for href in hrefs:
+            newurl = results.get(href)
+            if newurl is None:
+                newurl = results[href] = self._resolve(href, pipeline, netlocs)
+            ret.append(newurl)
+        return ret
+
+    def _resolve(self, href, pipeline, netlocs):
+        if self.scheme is None or pipeline.pre:
+            return _urlnorm(href, self.base, pipeline, netlocs)
+        newurl = href.strip()
+        newurl = ''.join((v for u in newurl.split('\n') for v in u.split('\r')))
+        if newurl.lower().startswith('feed:'):
+            newurl = newurl[5:]
+        i = newurl.find(':')
+        if not newurl or newurl[:2] == '//' or (i > 0 and not newurl[:i].strip(SCHEME_CHARS)):
+            # urljoin() returns the base itself, or a URL of its own
+            return _urlnorm(href, self.base, pipeline, netlocs)
+        return _resolve_relative(self, newurl, pipeline)
+
+def _resolve_relative(resolver, newurl, pipeline):
+    # The part of BaseResolver that does what _urlnorm() would otherwise
+    # do, so that statistics count it as a call to urlnorm()
+    parts = _split_hierarchy(newurl)
+    if parts.path[:1] == '/':
+        path, params = parts.path, parts.params
+    elif not parts.path and not parts.params:
+        path, params = resolver.path, resolver.params
+        if not parts.query:
+            parts.query = resolver.query
+    else:
+        path, params = _merge_path(resolver.directory, parts.path), parts.params
+    # Split the parameters off the last segment of the merged path
+    # again, as parsing the joined URL would
+    if params:
+        path = '%s;%s' % (path, params)
+    if path[:1] != '/' and path:
+        path = '/' + path
+    i = path.find(';', path.rfind('/') + 1)
+    if i >= 0:
+        path, params = path[:i], path[i+1:]
+    else:
+        params = ''
+    parts.scheme = resolver.scheme
+    parts.netloc = resolver.netloc
+    parts.username, parts.password, parts.hostname, parts.port = resolver.normalized_netloc
+    parts.path = _normalize_percent_encoding(path)
+    parts.params = _normalize_percent_encoding(params)
+    parts.query = _normalize_percent_encoding(parts.query)
+    parts.fragment = _normalize_percent_encoding(parts.fragment)
+    return _normalize_parts(parts, pipeline)
+
+def _merge_path(directory, path):
+    # Merge a relative path into the segments of the base URL's directory
+    # exactly as urlparse.urljoin() does, quirks included
+    segments = directory + path.split('/')
+    if segments[-1] == '.':
+        segments[-1] = ''
+    segments = [i for i in segments if i != '.']
+    # Drop each '..' together with the segment before it, except for the
+    # last segment, which is handled below
+    merged = []
+    for segment in segments[:-1]:
+        if segment == '..' and merged and merged[-1] not in ('', '..'):
+            merged.pop()
+        else:
+            merged.append(segment)
+    merged.append(segments[-1])
+    if merged == ['', '..']:
+        merged[-1] = ''
+    elif len(merged) >= 2 and merged[-1] == '..':
+        merged[-2:] = ['']
+    return '/'.join(merged)
+
+def urlnorm_shard(url, shards, base=None, key='host'):
+    return urlnorm_shard_many([url], shards, base, key)[0]
+
+def urlnorm_shard_many(urls, shards, base=None, key='host'):
+    # Return a (normalized URL, shard index) pair for each URL, where the
+    # shard index is shard_index() of the hostname that normalization
+    # produced, so the URLs do not need to be parsed again to route them
+    if key not in ('host', 'domain'):
+        raise ValueError("key must be 'host' or 'domain'")
+    pipeline = _current_pipeline()
+    if base is not None:
+        base = base.strip()
+    netlocs = {}
+    paths = {}
+    results = {}
+    indexes = {}
+    ret = []
+    for url in urls:
+        result = results.get(url)
+        if result is None:
+            newurl, hostname = _urlnorm(url, base, pipeline, netlocs, True, paths)
+            index = indexes.get(hostname)
+            if index is None:
+                index = indexes[hostname] = shard_index(hostname, shards, key)
+            result = results[url] = (newurl, index)
+        ret.append(result)
+    return ret
+
+def shard_index(hostname, shards, key='host'):
+    # Return a number in range(shards) that depends only on the hostname,
+    # or, if `key` is 'domain', on its registrable domain, so that it is
+    # the same in every process. URLs without a hostname share one shard
+    if key == 'domain':
+        hostname = _registrable_domain(hostname)
+    elif key != 'host':
+        raise ValueError("key must be 'host' or 'domain'")
+    return _fingerprint(hostname or '', 64) % shards
+
+# Second-level labels under which country-code domains are commonly
+# registered, as in example.co.uk or example.com.au
+_SECOND_LEVEL_LABELS = frozenset(['ac', 'co', 'com', 'edu', 'gob', 'go', 'gov', 'ltd',
+                                  'mil', 'ne', 'net', 'nhs', 'or', 'org', 'plc', 'sch'])
+
+def _registrable_domain(hostname):
+    # An approximation of the registrable domain that does not need the
+    # Public Suffix List: the last two labels of the hostname, or the last
+    # three when the hostname ends in a country code and a common
+    # second-level label. IP addresses are returned unchanged
+    if not hostname or hostname[:1] == '[' or '0' <= hostname[-1:] <= '9':
+        return hostname
+    labels = hostname.split('.')
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVEL_LABELS:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+def fingerprint(url, base=None, bits=64):
+    # Return a `bits`-wide integer hash of the normalized URL, for
+    # deduplicating URLs without keeping the normalized strings around
+    return _fingerprint(urlnorm(url, base), bits)
+
+def fingerprint_many(urls, base=None, bits=64):
+    return [_fingerprint(url, bits) for url in urlnorm_many(urls, base)]
+
+def _fingerprint(url, bits):
+    if bits not in (32, 64, 128):
+        raise ValueError('bits must be 32, 64 or 128')
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return int(hashlib.md5(url).hexdigest()[:bits // 4], 16)
+
+class BloomFilter(object):
+    # A set of 64-bit fingerprints that uses a fixed amount of memory.
+    # Membership tests have no false negatives, and false positives occur
+    # at roughly `error_rate` once `capacity` fingerprints have been added
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, fp):
+        # Derive the bit positions from two halves of the fingerprint
+        h1 = fp & 0xFFFFFFFF
+        h2 = (fp >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, fp):
+        bits = self.bits
+        for i in self._positions(fp):
+            if not bits[i >> 3] & (1 << (i & 7)):
+                return False
+        return True
+
+    def add(self, fp):
+        # Add `fp` and return True if it was (probably) not present before
+        bits = self.bits
+        new = False
+        for i in self._positions(fp):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                bits[i >> 3] |= mask
+                new = True
+        return new
+
+def dedupe(urls, base=None, seen=None, capacity=10000000, error_rate=0.001,
+           chunksize=10000):
+    # Yield each normalized URL the first time it is seen. `seen` is any
+    # object with an add() method that returns True for new fingerprints,
+    # like a BloomFilter (the default) or a FingerprintSet
+    if seen is None:
+        seen = BloomFilter(capacity, error_rate)
+    for chunk in _chunks(urls, chunksize):
+        for url in urlnorm_many(chunk, base):
+            if seen.add(_fingerprint(url, 64)):
+                yield url
+
+class FingerprintSet(set):
+    # An exact set of fingerprints for use with dedupe()
+    def add(self, fp):
+        if fp in self:
+            return False
+        set.add(self, fp)
+        return True
+
+def urlnorm_parallel(urls, base=None, processes=None, chunksize=10000):
+    # Normalize the URLs in chunks on a pool of worker processes.
+    # `processes` defaults to the number of CPUs
+    pool = _pool(processes)
+    try:
+        ret = []
+        chunks = ((chunk, base) for chunk in _chunks(urls, chunksize))
+        for results in _imap_ordered(pool, _normalize_chunk, chunks, processes):
+            ret.extend(results)
+        return ret
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _pool(processes):
+    import multiprocessing
+    pipeline = _current_pipeline()
+    return multiprocessing.Pool(processes, _init_worker,
+        (pipeline.pre_source, pipeline.post_source, _query_filter, _disk_cache))
+
+def _init_worker(pre_plugins, post_plugins, query_filter, disk_cache=None):
+    # Workers that are not forked from the parent (for instance on
+    # Windows) must be given the parent's plugins explicitly
+    global _query_filter, _disk_cache
+    _query_filter = query_filter
+    _disk_cache = disk_cache
+    _set_plugins(pre_plugins, post_plugins)
+
+def _chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _imap_ordered(pool, fn, iterable, processes):
+    # Like Pool.imap(), but only keeps a few tasks in flight per worker
+    # instead of consuming the entire input up front
+    if not processes:
+        import multiprocessing
+        processes = multiprocessing.cpu_count()
+    window = 2 * processes
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(pool.apply_async(fn, (args,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def normalize_file(src, dst, base=None, field=None, processes=None,
+                   chunk_size=1 << 22, checkpoint=None, shards=None, key='host'):
+    # Normalize the newline-delimited URLs (or, if `field` is given, JSON
+    # lines) in the file `src` and write them to the file `dst` in order,
+    # like the command line does. The input is memory-mapped and split
+    # into chunks of roughly `chunk_size` bytes at line boundaries; each
+    # chunk is read and normalized by a worker if `processes` is more
+    # than 1. If `checkpoint` is given, the progress is recorded in that
+    # file after every chunk, and an interrupted run that is started
+    # again with the same checkpoint resumes where it stopped.
+    # If `shards` is given, `dst` is a pattern like 'frontier-%d.txt' or a
+    # list of `shards` paths, and every line is written to the file chosen
+    # by urlnorm_shard() (lines that cannot be normalized go with the URLs
+    # that have no hostname).
+    # Returns {'lines': ..., 'failures': ..., 'offset': ...}
+    import mmap
+    if shards is None:
+        paths = [dst]
+    elif isinstance(dst, basestring):
+        paths = [dst % i for i in range(shards)]
+    else:
+        paths = list(dst)
+        if len(paths) != shards:
+            raise ValueError('expected %d output paths, got %d' % (shards, len(paths)))
+    start = 0
+    offsets = [0] * len(paths)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            state = json.load(f)
+        start = state['src']
+        offsets = state['dst'] if shards is not None else [state['dst']]
+        if not isinstance(offsets, list) or len(offsets) != len(paths) or \
+            not all(isinstance(offset, (int, long)) for offset in offsets):
+            raise ValueError('checkpoint %s does not match %s' % (checkpoint,
+                             'the %d shards' % shards if shards is not None else 'one output file'))
+    outs = []
+    for path, offset in zip(paths, offsets):
+        out = io.open(path, 'r+b' if offset else 'wb', 1 << 20)
+        out.truncate(offset)
+        out.seek(offset)
+        outs.append(out)
+    pool = None
+    if processes is not None and processes > 1:
+        pool = _pool(processes)
+    count = failures = 0
+    try:
+        with open(src, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            m = None
+            if size:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                ranges = _file_ranges(m, start, size, chunk_size)
+                tasks = ((src, i, j, base, field, shards, key) for i, j in ranges)
+                if pool is None:
+                    results = itertools.imap(_normalize_file_range, tasks)
+                else:
+                    results = _imap_ordered(pool, _normalize_file_range, tasks, processes)
+                for end, data, chunk_count, chunk_failures in results:
+                    if shards is None:
+                        data = [data]
+                    for out, chunk in zip(outs, data):
+                        out.write(chunk)
+                    count += chunk_count
+                    failures += chunk_failures
+                    start = end
+                    if checkpoint is not None:
+                        # The output must be on disk before the checkpoint
+                        # that points past it
+                        offsets = []
+                        for out in outs:
+                            out.flush()
+                            os.fsync(out.fileno())
+                            offsets.append(out.tell())
+                        _write_checkpoint(checkpoint, start,
+                                          offsets if shards is not None else offsets[0])
+            finally:
+                if m is not None:
+                    m.close()
+    finally:
+        for out in outs:
+            out.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return {'lines': count, 'failures': failures, 'offset': start}
+
+def _file_ranges(m, start, size, chunk_size):
+    # Yield (start, end) byte ranges that end just after a newline
+    while start < size:
+        end = m.find('\n', min(start + chunk_size, size) - 1)
+        end = size if end < 0 else end + 1
+        yield start, end
+        start = end
+
+def _normalize_file_range(args):
+    import mmap
+    path, start, end, base, field, shards, key = args
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lines = m[start:end].split('\n')
+        finally:
+            m.close()
+    if lines[-1] == '':
+        lines.pop()
+    data, failures = _normalize_lines(lines, base, field, shards, key)
+    flush_disk_cache()
+    return end, data, len(lines), failures
+
+def _write_checkpoint(path, src_offset, dst_offset):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        json.dump({'src': src_offset, 'dst': dst_offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+    _fsync_directory(path)
+
+def _fsync_directory(path):
+    # Make a rename in the directory of `path` durable. Directories
+    # cannot be opened for this on Windows
+    if os.name == 'nt':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _normalize_chunk(args):
+    urls, base = args
+    ret = urlnorm_many(urls, base)
+    # Pool workers are terminated without running exit handlers
+    flush_disk_cache()
+    return ret
+
+def _urlnorm(url, base, pipeline, netlocs, with_host=False, paths=None,
+             fast=True):
+    # If `with_host` is true, returns (normalized URL, hostname) instead,
+    # where the hostname is None for URLs that are returned unchanged.
+    # `netlocs` and `paths` hold the netlocs and paths that were already
+    # normalized in the same batch of URLs, or are None. If `fast` is
+    # false, the caller has already checked the fast path
+    if fast and pipeline.fast_path and base is None:
+        if _is_canonical(url):
+            next(_fast_path_taken)
+            if with_host:
+                # Canonical URLs have no userinfo and always have a path
+                host = url[url.index('://') + 3:]
+                return url, host[:host.index('/')].partition(':')[0]
+            return url
+        next(_fast_path_missed)
     newurl = url.strip()
     newurl = ''.join((v for u in newurl.split('\n') for v in u.split('\r')))
     if newurl.lower().startswith('feed:'):
         newurl = newurl[5:]
     if base is not None:
-        newurl = urlparse.urljoin(base.strip(), newurl)
-    for fn in _pre_plugins:
-        newurl = fn(newurl)
+        newurl = urlparse.urljoin(base, newurl)
+    newurl = pipeline.run_pre(newurl)
     newurl = _normalize_percent_encoding(newurl)
     parts = _urlparse(newurl)
     if parts is None:
-        return url
-    parts.update(_split_netloc(parts['netloc']))
-    parts['scheme'] = _normalize_scheme(parts['scheme'])
-    parts['port'] = _normalize_port(parts['port'], parts['scheme'])
-    parts['path'] = _normalize_path(parts['path'])
-    parts['hostname'] = _normalize_hostname(parts.get('hostname', ''))
-    parts['query'] = _split_query(parts['query'])
-    for fn in _post_plugins:
-        parts.update(fn(parts))
+        return (url, None) if with_host else url
+    parts.scheme = _normalize_scheme(parts.scheme)
+    key = (parts.netloc, parts.scheme)
+    if netlocs is None:
+        netloc = _cached_normalize_netloc(key)
+    else:
+        netloc = netlocs.get(key)
+        if netloc is None:
+            netloc = netlocs[key] = _cached_normalize_netloc(key)
+    parts.username, parts.password, parts.hostname, parts.port = netloc
+    return _normalize_parts(parts, pipeline, with_host, paths)
+
+def _normalize_parts(parts, pipeline, with_host=False, paths=None):
+    if paths is None:
+        parts.path = _normalize_path(parts.path)
+    else:
+        path = paths.get(parts.path)
+        if path is None:
+            path = paths[parts.path] = _normalize_path(parts.path)
+        parts.path = path
+    if pipeline.query_filter is None:
+        parts.query = _split_query(parts.query)
+    else:
+        keep = pipeline.query_filter.keep_function(parts.hostname)
+        parts.query = _split_query(parts.query, keep)
+    parts = pipeline.run_post(parts)
+    if with_host:
+        return _join_parts(parts), parts.hostname
     return _join_parts(parts)
 
+# Matches http and https URLs whose scheme, hostname, port, path and query
+# are already written the way urlnorm() would write them. The hostname's
+# last label must start with a letter so that it cannot be a numeric IP
+# address, path segments must not be empty, and the query may only
+# contain characters that never need to be escaped
+CANONICAL_URL = _LazyPattern(r"""
+    ^
+    (?P<scheme>https?)://
+    (?:[a-z0-9_-]+[.])*[a-z][a-z0-9_-]*
+    (?::(?P<port>[0-9]+))?
+    (?P<path>/(?:[A-Za-z0-9._~!$&'()*+,=:@%-]+(?:/[A-Za-z0-9._~!$&'()*+,=:@%-]+)*/?)?)
+    (?:[?](?P<query>[A-Za-z0-9_.~/=&-]+))?
+    (?:[#][!-~]+)?
+    \Z
+    """, re.VERBOSE
+)
+DOT_SEGMENT = _LazyPattern(r'/[.][.]?(?:/|\Z)')
+
+# next() of an itertools.count() is atomic, so the counters need no lock
+_fast_path_taken = itertools.count()
+_fast_path_missed = itertools.count()
+
+def fast_path_info():
+    # Return how many URLs were (and were not) recognized as canonical
+    # and returned without being parsed
+    return {'taken': _count_value(_fast_path_taken),
+            'missed': _count_value(_fast_path_missed)}
+
+def _is_canonical(url):
+    m = CANONICAL_URL.match(url)
+    if m is None:
+        return False
+    scheme, port, path, query = m.group('scheme', 'port', 'path', 'query')
+    if port is not None and DEFAULT_PORTS[scheme] == port:
+        return False
+    if '/.' in path and DOT_SEGMENT.search(path):
+        return False
+    if '%' in url:
+        for hexpair in PERCENT_ENCODING.findall(url):
+            if hexpair != hexpair.upper() or chr(int(hexpair, 16)) in UNRESERVED:
+                return False
+    if query is not None:
+        # The parameters must be non-empty, contain at most one '=',
+        # and already be sorted
+        pairs = []
+        for pair in query.split('&'):
+            name, sep, value = pair.partition('=')
+            if not pair or '=' in value:
+                return False
+            pairs.append((name, value if sep else None))
+        if pairs != sorted(pairs):
+            return False
+    return True
+
+class ParsedURL(object):
+    # The parts of a URL. Post plugins receive one of these, and it is
+    # also a complete mutable mapping, like the dictionary that older
+    # plugins expect. Keys other than the parts of the URL can be stored
+    # too, but are ignored when the URL is put back together. Deleting a
+    # part of the URL resets it to its empty value
+    _fields = ('scheme', 'netloc', 'username', 'password', 'hostname',
+               'port', 'path', 'params', 'query', 'fragment')
+    __slots__ = _fields + ('_extra',)
+
+    def __init__(self, scheme='', netloc='', path='', params='', query='',
+                 fragment='', username=None, password=None, hostname='',
+                 port=None):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.username = username
+        self.password = password
+        self.hostname = hostname
+        self.port = port
+        self.path = path
+        self.params = params
+        self.query = query
+        self.fragment = fragment
+        self._extra = None
+
+    def __getitem__(self, key):
+        if key in _PARSEDURL_KEYS:
+            return getattr(self, key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _PARSEDURL_KEYS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _PARSEDURL_KEYS:
+            setattr(self, key, None if key in ('username', 'password', 'port') else '')
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        return key in _PARSEDURL_KEYS or (self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        if self._extra:
+            return itertools.chain(self._fields, list(self._extra))
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields) + len(self._extra or ())
+
+    def __eq__(self, other):
+        if not isinstance(other, (ParsedURL, dict)):
+            return NotImplemented
+        return self.copy() == dict(other.items())
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ParsedURL(%s)' % ', '.join('%s=%r' % (k, self[k]) for k in self)
+
+    def get(self, key, default=None):
+        if key in _PARSEDURL_KEYS:
+            return getattr(self, key)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    has_key = __contains__
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return (self[k] for k in self)
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self)
+
+    def copy(self):
+        # A plain dictionary, as dict.copy() would have returned
+        return dict(self.iteritems())
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        # Only the extra keys can really be removed
+        if not self._extra:
+            raise KeyError('popitem(): no extra keys')
+        return self._extra.popitem()
+
+    def clear(self):
+        for k in self.keys():
+            del self[k]
+
+    def update(self, other=(), **kwargs):
+        if other is not self:
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    self[k] = other[k]
+            else:
+                for k, v in other:
+                    self[k] = v
+        for k in kwargs:
+            self[k] = kwargs[k]
+
+_PARSEDURL_KEYS = frozenset(ParsedURL._fields)
+collections.MutableMapping.register(ParsedURL)
+
+SCHEME_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+-.'
+DIGITS = '0123456789'
+
 def _urlparse(url):
-    parts = dict(zip(('scheme', 'netloc', 'path', 'params', 'query', 'fragment'),
-                     urlparse.urlparse(url)
-                ))
-    if (not parts['scheme'] and not parts['netloc']) or \
+    # This follows the rules of urlparse.urlparse() for the parts of a URL
+    # that urlnorm() cares about, but avoids the namedtuple, the dict(zip())
+    # and the second parse that are otherwise needed when a URL has no scheme
+    scheme = ''
+    rest = url
+    i = url.find(':')
+    if i > 0:
+        if url[:i] == 'http':
+            scheme = 'http'
+            rest = url[i+1:]
+        elif not url[:i].strip(SCHEME_CHARS):
+            # Make sure that `rest` is not actually a port number,
+            # in which case the "scheme" is really part of the path
+            if not url[i+1:] or url[i+1:].strip(DIGITS):
+                scheme = url[:i].lower()
+                rest = url[i+1:]
+    parts = _split_hierarchy(rest)
+    if (not scheme and not parts.netloc) or \
         (
-            not parts['netloc'] and
-            parts['path'] and
-            parts['path'][0] in map(str, range(10)) and
-            url.startswith('%s:%s' % (parts['scheme'], parts['path']))
+            not parts.netloc and
+            parts.path and
+            parts.path[0] in DIGITS and
+            url.startswith('%s:%s' % (scheme, parts.path))
         ):
         # url may not have included a scheme, like 'domain.example'
         # url may have been in the form 'domain.example:8080'
-        parts = dict(zip(('scheme', 'netloc', 'path', 'params', 'query', 'fragment'),
-                         urlparse.urlparse('http://%s' % url)
-                    ))
-    elif parts['scheme'].lower() not in ('http', 'https'):
+        scheme = 'http'
+        parts = _split_hierarchy('//' + url)
+    elif scheme not in ('http', 'https'):
         return None
+    parts.scheme = scheme
     return parts
 
+def _split_hierarchy(url):
+    netloc = params = query = fragment = ''
+    if url[:2] == '//':
+        end = len(url)
+        for c in '/?#':
+            i = url.find(c, 2)
+            if 0 <= i < end:
+                end = i
+        netloc = url[2:end]
+        url = url[end:]
+        if ('[' in netloc) != (']' in netloc):
+            raise ValueError("Invalid IPv6 URL")
+        _check_netloc(netloc)
+    i = url.find('#')
+    if i >= 0:
+        url, fragment = url[:i], url[i+1:]
+    i = url.find('?')
+    if i >= 0:
+        url, query = url[:i], url[i+1:]
+    i = url.find(';', url.rfind('/') + 1)
+    if i >= 0:
+        url, params = url[:i], url[i+1:]
+    return ParsedURL('', netloc, url, params, query, fragment)
+
+def _check_netloc(netloc):
+    # Reject netlocs with characters that change meaning under NFKC
+    # normalization, as urlparse.urlsplit() does (CVE-2019-9636)
+    if not isinstance(netloc, unicode):
+        return
+    try:
+        netloc.encode('ascii')
+        return
+    except UnicodeEncodeError:
+        pass
+    n = netloc.replace(u'@', u'').replace(u':', u'').replace(u'#', u'').replace(u'?', u'')
+    netloc2 = unicodedata.normalize('NFKC', n)
+    if n != netloc2:
+        for c in '/?#@:':
+            if c in netloc2:
+                raise ValueError(u"netloc '%s' contains invalid characters "
+                                 u"under NFKC normalization" % netloc)
+
 def _join_parts(parts):
-    url = '%s://' % parts['scheme']
-    if parts['username']:
-        url += parts['username']
-        if parts['password']:
-            url += ':%s' % parts['password']
+    url = '%s://' % parts.scheme
+    if parts.username:
+        url += parts.username
+        if parts.password:
+            url += ':%s' % parts.password
         url += '@'
-    url += parts['hostname']
-    if parts['port']:
-        url += ':%s' % parts['port']
-    url += parts['path']
-    if parts['params']:
-        url += ';%s' % parts['params']
-    if parts['query']:
-        url += '?%s' % _join_query(parts['query'])
-    if parts['fragment']:
-        url += '#%s' % parts['fragment']
+    url += parts.hostname
+    if parts.port:
+        url += ':%s' % parts.port
+    url += parts.path
+    if parts.params:
+        url += ';%s' % parts.params
+    if parts.query:
+        url += '?%s' % _join_query(parts.query)
+    if parts.fragment:
+        url += '#%s' % parts.fragment
     return url
 
 def _split_netloc(netloc):
-    parts_netloc = NETLOC.match(netloc)
-    if parts_netloc is not None:
-        return parts_netloc.groupdict()
+    # Equivalent to matching the netloc against the pattern
+    # [username][:password]@hostname[:port], where only the hostname is
+    # required and the userinfo ends at the first @
+    i = netloc.find('@')
+    if i >= 0:
+        parts = _split_hostport(netloc[i+1:])
+        if parts is not None:
+            userinfo = netloc[:i]
+            i = userinfo.find(':')
+            if i < 0:
+                parts['username'] = userinfo or None
+                parts['password'] = None
+            else:
+                parts['username'] = userinfo[:i] or None
+                parts['password'] = userinfo[i+1:]
+            return parts
+    parts = _split_hostport(netloc)
+    if parts is not None:
+        parts['username'] = None
+        parts['password'] = None
+        return parts
     return {'username': '', 'password': '', 'hostname': '', 'port': ''}
 
+def _split_hostport(hostport):
+    i = hostport.find(':')
+    if hostport[:1] == '[':
+        # A bracketed IPv6 address contains colons of its own
+        j = hostport.find(']') + 1
+        if j and hostport[j:j+1] in ('', ':') and not hostport[1:j-1].strip(IPV6_CHARS):
+            i = j if hostport[j:] else -1
+    if i < 0:
+        hostname, port = hostport, None
+    else:
+        hostname, port = hostport[:i], hostport[i+1:]
+        if port.strip(DIGITS):
+            return None
+    if not hostname:
+        return None
+    return {'hostname': hostname, 'port': port}
+
+def _cached_normalize_netloc(key):
+    cache = _host_cache
+    if cache is None:
+        return _normalize_netloc(*key)
+    netloc = cache.get(key)
+    if netloc is None:
+        netloc = _normalize_netloc(*key)
+        cache.set(key, netloc)
+    return netloc
+
+def _normalize_netloc(netloc, scheme):
+    # Returns (username, password, hostname, port)
+    parts = _split_netloc(netloc)
+    return (parts['username'], parts['password'],
+            _normalize_hostname(parts['hostname']),
+            _normalize_port(parts['port'], scheme))
+
 def _normalize_scheme(scheme):
     return scheme.lower() or 'http'
 
@@ -154,33 +2071,134 @@ def _normalize_port(port, scheme):
         return ''
     return port
 
+def _percent_decode_table():
+    # Map every spelling of each of the 256 escapes, like '7e' and '7E', to
+    # its replacement: the character itself if it is unreserved, otherwise
+    # the escape in upper case
+    table = {}
+    for i in range(256):
+        c = unichr(i)
+        replacement = c if c in UNRESERVED else u'%%%02X' % i
+        for hexpair in set(['%02x' % i, '%02X' % i, '%x%X' % divmod(i, 16), '%X%x' % divmod(i, 16)]):
+            table[hexpair] = replacement
+    return table
+
+_PERCENT_DECODE = _percent_decode_table()
+# The same replacements for byte strings, so that they stay byte strings
+_PERCENT_DECODE_BYTES = dict((k, str(v)) for k, v in _PERCENT_DECODE.items())
+
 def _normalize_percent_encoding(txt):
-    unreserved = u'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.~'
-    def repl(hexpair):
-        if unichr(int(hexpair.group(1), 16)) in unreserved:
-            return unichr(int(hexpair.group(1), 16))
-        return u'%%%s' % hexpair.group(1).upper()
-    return re.sub(PERCENT_ENCODING, repl, txt)
+    if '%' not in txt:
+        return txt
+    pieces = txt.split('%')
+    decode = _PERCENT_DECODE if isinstance(txt, unicode) else _PERCENT_DECODE_BYTES
+    changed = False
+    for i in xrange(1, len(pieces)):
+        piece = pieces[i]
+        replacement = decode.get(piece[:2])
+        if replacement is None:
+            pieces[i] = '%' + piece
+        else:
+            pieces[i] = replacement + piece[2:]
+            changed = True
+    if not changed:
+        return txt
+    return ''.join(pieces)
 
 def _normalize_hostname(hostname):
     hostname = hostname.lower()
     if hostname.endswith('.'):
         hostname = hostname[:-1]
-    ip = NUMERIC_IP.match(hostname)
-    if ip is not None:
-        ip = filter(None, ip.groups())
-        decimal_ip = 0
-        for i in range(len(ip)):
-            base = (10, 8, 16)[(ip[i][0:1] == '0') + (ip[i][1:2] == 'x')]
-            decimal_ip += (
-                (long(ip[i] or '0', base) &
-                (256**[1, 4-i][len(ip)==i+1]-1)) <<
-                (8*[3-i, 0][len(ip)==i+1])
-            )
-        new_ip = '.'.join([unicode((decimal_ip >> (8*octet)) & 255) for octet in (3, 2, 1, 0)])
-        hostname = new_ip
+    if hostname[:1] == '[':
+        return _normalize_ipv6(hostname)
+    # Only a host whose last label starts with a digit can be numeric,
+    # so ordinary domain names are returned without further work
+    if '0' <= hostname[hostname.rfind('.')+1:][:1] <= '9':
+        ip = _parse_ipv4(hostname)
+        if ip is not None:
+            return '%d.%d.%d.%d' % (ip >> 24, (ip >> 16) & 255, (ip >> 8) & 255, ip & 255)
     return hostname
 
+def _parse_ipv4(hostname):
+    # Return an IPv4 address written as up to four decimal, octal or
+    # hexadecimal numbers as an integer, or None. As in inet_aton(), the
+    # last number fills all of the remaining bytes, and the other numbers
+    # are truncated to a single byte.
+    labels = hostname.split('.')
+    if len(labels) > 4:
+        return None
+    ip = 0
+    for label in labels:
+        if label and not label.strip(DIGITS):
+            if label[0] != '0':
+                n = int(label)
+            elif not label.strip('01234567'):
+                n = int(label, 8)
+            else:
+                return None
+        elif label[:2] == '0x' and label[2:] and not label[2:].strip(HEXDIGITS):
+            n = int(label[2:], 16)
+        else:
+            return None
+        ip = (ip << 8) | (n & 255)
+    shift = 8 * (5 - len(labels))
+    return ((ip >> 8) << shift) | (n & ((1 << shift) - 1))
+
+def _normalize_ipv6(hostname):
+    # Write a bracketed IPv6 address in the form recommended by RFC 5952;
+    # anything else, like an IPvFuture address or a zone identifier, is
+    # returned unchanged
+    groups = _parse_ipv6(hostname[1:-1])
+    if hostname[-1:] != ']' or groups is None:
+        return hostname
+    if groups[:6] == [0, 0, 0, 0, 0, 0xffff]:
+        return '[::ffff:%d.%d.%d.%d]' % (groups[6] >> 8, groups[6] & 255,
+                                         groups[7] >> 8, groups[7] & 255)
+    # Find the longest run of two or more zero groups, the first one on a tie
+    start = length = 0
+    i = 0
+    while i < 8:
+        j = i
+        while j < 8 and groups[j] == 0:
+            j += 1
+        if j - i > max(length, 1):
+            start, length = i, j - i
+        i = j + 1
+    groups = ['%x' % g for g in groups]
+    if not length:
+        return '[%s]' % ':'.join(groups)
+    return '[%s::%s]' % (':'.join(groups[:start]), ':'.join(groups[start+length:]))
+
+def _parse_ipv6(address):
+    # Return the eight 16-bit groups of an IPv6 address, or None
+    if '.' in address:
+        # The last 32 bits may be written as a dotted-decimal IPv4 address
+        i = address.rfind(':')
+        octets = address[i+1:].split('.')
+        if i < 0 or len(octets) != 4:
+            return None
+        for octet in octets:
+            if not octet or len(octet) > 3 or octet.strip(DIGITS) or int(octet) > 255:
+                return None
+        address = '%s%x:%x' % (address[:i+1], int(octets[0]) << 8 | int(octets[1]),
+                               int(octets[2]) << 8 | int(octets[3]))
+    head, sep, tail = address.partition('::')
+    head = head.split(':') if head else []
+    tail = tail.split(':') if tail else []
+    if sep:
+        fill = 8 - len(head) - len(tail)
+        if fill < 1:
+            return None
+        groups = head + ['0'] * fill + tail
+    else:
+        groups = head
+        if len(groups) != 8:
+            return None
+    for group in groups:
+        if not 0 < len(group) <= 4 or group.strip(HEXDIGITS):
+            return None
+    return [int(group, 16) for group in groups]
+
 def _normalize_path(path):
     path = path.split('/')
     endslash = False
@@ -206,33 +2224,487 @@ def _normalize_path(path):
         path.append('')
     return '/'.join(filter(lambda x: x is not None, path)) or '/'
 
-def _split_query(query):
+def _split_query(query, keep=None):
     # The following code's basic logic was found in the Python 2.6
-    # urlparse library, but was modified due to differing needs
+    # urlparse library, but was modified due to differing needs.
+    # If `keep` is given, only parameters whose names it returns True for
+    # are included
     ret = {}
-    queries = [j for i in query.split('&') for j in i.split(';')]
-    if queries == ['']:
+    if not query:
         return ret
-    for q in queries:
-        nv = q.split('=', 1)
-        if len(nv) == 1:
+    for q in query.replace(';', '&').split('&'):
+        name, sep, value = q.partition('=')
+        if keep is not None and not keep(name):
+            continue
+        if not sep:
             # Differentiate between `?n=` and ?n`
-            nv.append(None)
-        ret.setdefault(nv[0], []).append(nv[1])
+            value = None
+        values = ret.get(name)
+        if values is None:
+            ret[name] = [value]
+        else:
+            values.append(value)
     return ret
 
+class _QueryEscapes(dict):
+    # Maps each character to itself if it is acceptable in a query,
+    # and to its percent-escape otherwise
+    def __missing__(self, c):
+        return '%%%X' % ord(c)
+
+# Byte strings and unicode strings need separate tables because
+# '\xe9' and u'\xe9' hash identically but do not compare equal
+_QUERY_ESCAPES = _QueryEscapes()
+_UNICODE_QUERY_ESCAPES = _QueryEscapes()
+for i in range(256):
+    if UNACCEPTABLE_QUERY_CHARS.match(chr(i)):
+        _QUERY_ESCAPES[chr(i)] = _UNICODE_QUERY_ESCAPES[unichr(i)] = '%%%X' % i
+    else:
+        _QUERY_ESCAPES[chr(i)] = _UNICODE_QUERY_ESCAPES[unichr(i)] = chr(i)
+del i
+
+def _quote_query(s):
+    if UNACCEPTABLE_QUERY_CHARS.search(s) is None:
+        return s
+    if isinstance(s, unicode):
+        return ''.join(map(_UNICODE_QUERY_ESCAPES.__getitem__, s))
+    return ''.join(map(_QUERY_ESCAPES.__getitem__, s))
+
 def _join_query(qdict):
-    def replace(s):
-        return u'%%%s' % hex(ord(s.group(1)))[2:].upper()
-    ret = ''
-    for k in sorted(qdict.keys()):
+    ret = []
+    for k in sorted(qdict):
+        quoted_k = _quote_query(k)
         for v in sorted(qdict[k]):
             if v is None:
-                ret += '&%s' % (re.sub(UNACCEPTABLE_QUERY_CHARS, replace, k),)
+                ret.append(quoted_k)
             elif not v:
-                ret += '&%s=' % (re.sub(UNACCEPTABLE_QUERY_CHARS, replace, k),)
+                ret.append(quoted_k + '=')
+            else:
+                ret.append(quoted_k + '=' + _quote_query(v))
+    return '&'.join(ret)
+
+# The normalization service speaks newline-delimited JSON. Each request is
+# an object like {"id": 1, "urls": [...], "base": null} and is answered
+# with {"id": 1, "urls": [...]}. Requests can be pipelined, and the
+# answers on a connection are sent in the order of the requests.
+# {"command": "stats"} returns the request latency percentiles and the
+# cache counters. Errors are answered with {"error": "..."}
+
+class _LatencyStats(object):
+    def __init__(self, size=10000):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=size)
+        self.requests = 0
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.requests += 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            ret = {'requests': self.requests}
+        for p in (50, 90, 99):
+            ret['p%d' % p] = None
+            if latencies:
+                ret['p%d' % p] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+        return ret
+
+class _ServerMixIn:
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def respond(self, line):
+        start = time.time()
+        response = {}
+        try:
+            request = json.loads(line)
+            if 'id' in request:
+                response['id'] = request['id']
+            if request.get('command') == 'stats':
+                response['stats'] = self.latency.snapshot()
+                response['cache'] = cache_info()
+            elif self.pool is None:
+                response['urls'] = urlnorm_many(request['urls'], request.get('base'))
+            else:
+                response['urls'] = self.pool.apply(_normalize_chunk,
+                    ((request['urls'], request.get('base')),))
+        except Exception as e:
+            response['error'] = '%s: %s' % (e.__class__.__name__, e)
+        self.latency.add(time.time() - start)
+        return response
+
+    def server_close(self):
+        self.socket.close()
+        if not isinstance(self.server_address, tuple):
+            os.unlink(self.server_address)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+_service_classes = None
+
+def _get_service_classes():
+    # The server classes derive from SocketServer's, so they are defined
+    # when the first server is made rather than when urlnorm is imported
+    global _service_classes
+    if _service_classes is None:
+        import SocketServer
+
+        class _RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, ''):
+                    self.wfile.write(json.dumps(self.server.respond(line)) + '\n')
+
+        class _TCPServer(_ServerMixIn, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            pass
+
+        class _UnixServer(_ServerMixIn, SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            pass
+
+        _service_classes = (_RequestHandler, _TCPServer, _UnixServer)
+    return _service_classes
+
+def _parse_address(address):
+    # 'host:port' is a TCP address; anything else is a Unix socket path
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return (host or 'localhost', int(port))
+    return address
+
+def make_server(address, processes=None, cache_size=100000):
+    # Return a server for the normalization service; call its
+    # serve_forever() method to run it. Every connection is handled in
+    # a thread, and all of them share one warm cache and the plugins
+    # registered in this process. If `processes` is more than 1, the
+    # URLs are normalized on a pool of worker processes instead
+    address = _parse_address(address)
+    handler, tcp_server, unix_server = _get_service_classes()
+    if isinstance(address, tuple):
+        server = tcp_server(address, handler)
+    else:
+        server = unix_server(address, handler)
+    if cache_size and _cache is None:
+        enable_cache(cache_size)
+    server.latency = _LatencyStats()
+    server.pool = None
+    if processes is not None and processes > 1:
+        server.pool = _pool(processes)
+    return server
+
+class Client(object):
+    # A client for the normalization service started by make_server()
+    def __init__(self, address):
+        import socket
+        address = _parse_address(address)
+        if isinstance(address, tuple):
+            self._sock = socket.create_connection(address)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(address)
+        self._rfile = self._sock.makefile('rb')
+        self._next_id = 0
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
+
+    def normalize(self, urls, base=None):
+        return self.imap([urls], base).next()
+
+    def imap(self, batches, base=None, window=16):
+        # Send the batches of URLs without waiting for the answers, with
+        # up to `window` of them in flight, and yield the normalized
+        # batches in order. Sending happens in a separate thread so that
+        # neither side can block the other on full socket buffers
+        import Queue
+        slots = threading.Semaphore(window)
+        sent = Queue.Queue()
+        stop = threading.Event()
+        errors = []
+        def send():
+            try:
+                for urls in batches:
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    request_id = self._next_id
+                    self._next_id += 1
+                    self._sock.sendall(json.dumps(
+                        {'id': request_id, 'urls': list(urls), 'base': base}) + '\n')
+                    sent.put(request_id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                sent.put(None)
+        sender = threading.Thread(target=send)
+        sender.daemon = True
+        sender.start()
+        done = False
+        try:
+            while True:
+                request_id = sent.get()
+                if request_id is None:
+                    done = True
+                    break
+                response = self._receive()
+                if response.get('id') != request_id:
+                    raise ValueError('unexpected response from the urlnorm service')
+                slots.release()
+                yield response['urls']
+        finally:
+            if not done:
+                # An error response, or the caller stopped early. Stop the
+                # sender and read the answers that are still on their way,
+                # so that the connection can be used again
+                stop.set()
+                slots.release()
+                self._drain(sent)
+            sender.join()
+        if errors:
+            raise errors[0]
+
+    def _drain(self, sent):
+        try:
+            while True:
+                request_id = sent.get()
+                if request_id is None:
+                    break
+                if not self._rfile.readline():
+                    raise ValueError('the urlnorm service closed the connection')
+        except Exception:
+            # The connection cannot be used any more. Shutting it down
+            # also wakes up the sender if it is blocked
+            import socket
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.close()
+
+    def stats(self):
+        self._sock.sendall(json.dumps({'command': 'stats'}) + '\n')
+        return self._receive()
+
+    def _receive(self):
+        line = self._rfile.readline()
+        if not line:
+            raise ValueError('the urlnorm service closed the connection')
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+def _normalize_lines(lines, base, field, shards=None, key='host'):
+    # Returns the output lines joined into one string, or into a list of
+    # `shards` strings, and the number of failures
+    objs = []
+    urls = []
+    for line in lines:
+        try:
+            line = line.rstrip('\r\n')
+            if field is not None or _NON_ASCII.search(line) is not None:
+                line = line.decode('utf-8')
+            if field is not None:
+                obj = json.loads(line)
+                objs.append(obj)
+                urls.append(obj[field])
             else:
-                ret += '&%s=%s' % (re.sub(UNACCEPTABLE_QUERY_CHARS, replace, k),
-                                   re.sub(UNACCEPTABLE_QUERY_CHARS, replace, v)
-                                  )
-    return ret[1:]
+                urls.append(line)
+        except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+            objs.append(None)
+            urls.append(None)
+    try:
+        if shards is None:
+            results = urlnorm_many([url for url in urls if url], base)
+        else:
+            results = urlnorm_shard_many([url for url in urls if url], shards, base, key)
+    except Exception:
+        # Normalize the URLs individually to find the ones that fail
+        results = []
+        for url in urls:
+            if url:
+                try:
+                    if shards is None:
+                        results.append(urlnorm(url, base))
+                    else:
+                        results.append(urlnorm_shard(url, shards, base, key))
+                except Exception:
+                    results.append(None)
+    results = iter(results)
+    outs = [[] for i in range(shards or 1)]
+    ret = outs[0]
+    if shards is not None:
+        no_host = shard_index(None, shards)
+    failures = 0
+    for i, url in enumerate(urls):
+        newurl = url and results.next()
+        if shards is not None:
+            if newurl:
+                newurl, index = newurl
+            else:
+                index = no_host
+            ret = outs[index]
+        if newurl is None:
+            # Pass lines that could not be normalized through unchanged
+            failures += 1
+            ret.append(lines[i].rstrip('\r\n'))
+        elif field is not None:
+            objs[i][field] = newurl
+            ret.append(json.dumps(objs[i]).encode('utf-8'))
+        elif isinstance(newurl, unicode):
+            ret.append(newurl.encode('utf-8'))
+        else:
+            ret.append(newurl)
+        ret.append('\n')
+    if shards is None:
+        return ''.join(ret), failures
+    return [''.join(out) for out in outs], failures
+
+def _read_batches(files, batch_size, buffer_size):
+    for name in files:
+        if name == '-':
+            src = io.open(sys.stdin.fileno(), 'rb', buffer_size, closefd=False)
+        else:
+            src = io.open(name, 'rb', buffer_size)
+        with src:
+            for lines in _chunks(src, batch_size):
+                yield lines
+
+def _normalize_batch(args):
+    lines, base, field, shards, key = args
+    data, failures = _normalize_lines(lines, base, field, shards, key)
+    flush_disk_cache()
+    return data, len(lines), failures
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m urlnorm',
+        description='Normalize newline-delimited URLs or JSON lines.')
+    parser.add_argument('files', nargs='*', default=['-'], metavar='FILE',
+        help='files to read (default: standard input)')
+    parser.add_argument('-o', '--output', default='-',
+        help='file to write (default: standard output)')
+    parser.add_argument('--base', help='base URL for relative URLs')
+    parser.add_argument('--jsonl-field', metavar='FIELD',
+        help='read JSON lines and normalize FIELD of each object')
+    parser.add_argument('--pre-plugin', action='append', default=[],
+        metavar='PLUGIN', help='register a pre plugin, like msplinks')
+    parser.add_argument('--post-plugin', action='append', default=[],
+        metavar='PLUGIN', help='register a post plugin, like nowww or indexes')
+    parser.add_argument('--plugins', metavar='FILE',
+        help='register the plugins and query filter listed in the JSON file '
+             'FILE, as written by urlnorm.freeze_plugins()')
+    parser.add_argument('--deny-param', action='append', default=[], metavar='RULE',
+        help='remove query parameters matching RULE, like utm_* or fbclid')
+    parser.add_argument('--allow-param', action='append', metavar='RULE',
+        help='remove query parameters that match no --allow-param RULE')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=10000,
+        help='number of lines normalized at once (default: %(default)s)')
+    parser.add_argument('--buffer-size', type=int, default=1 << 20,
+        help='size of the I/O buffers in bytes (default: %(default)s)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+        help='memory-map the one input file, record the progress in FILE and '
+             'resume from it if it exists; requires --output')
+    parser.add_argument('--shards', type=int, metavar='N',
+        help='write the URLs to N files partitioned by host; --output must '
+             'contain %%d, which is replaced with the shard number')
+    parser.add_argument('--shard-key', choices=('host', 'domain'), default='host',
+        help='partition by hostname or by registrable domain (default: %(default)s)')
+    parser.add_argument('--disk-cache', metavar='FILE',
+        help='keep normalized URLs in the SQLite database FILE and reuse them '
+             'in later runs and other processes')
+    parser.add_argument('--serve', metavar='ADDRESS',
+        help='run the normalization service on ADDRESS, which is host:port '
+             'or the path of a Unix socket, instead of reading files')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='do not print a summary to standard error')
+    args = parser.parse_args(argv)
+    if args.checkpoint and (args.output == '-' or len(args.files) != 1 or args.files[0] == '-'):
+        parser.error('--checkpoint requires one input file and --output')
+    if args.shards is not None and (args.shards < 1 or '%d' not in args.output):
+        parser.error('--shards requires a positive number and an --output pattern with %d')
+
+    if args.plugins:
+        try:
+            load_plugins(args.plugins)
+        except ImportError as e:
+            parser.error('cannot load plugin: %s' % e)
+    # Import the plugins named on the command line right away, so that a
+    # mistyped name is an error instead of a failure on every line
+    for names, register in ((args.pre_plugin, register_pre_plugin),
+                            (args.post_plugin, register_post_plugin)):
+        for name in names:
+            plugin = _LazyPlugin(name)
+            try:
+                plugin._load()
+            except (ImportError, AttributeError, IOError, SyntaxError) as e:
+                parser.error('cannot load plugin %s: %s' % (name, e))
+            register(plugin)
+    if args.deny_param or args.allow_param is not None:
+        set_query_filter(QueryFilter(args.deny_param, args.allow_param))
+    if args.disk_cache:
+        enable_disk_cache(args.disk_cache)
+
+    if args.serve:
+        server = make_server(args.serve, args.processes)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    start = time.time()
+    if args.checkpoint:
+        result = normalize_file(args.files[0], args.output, args.base, args.jsonl_field,
+                                args.processes, checkpoint=args.checkpoint,
+                                shards=args.shards, key=args.shard_key)
+        count, failures = result['lines'], result['failures']
+    else:
+        if args.shards is not None:
+            outs = [io.open(args.output % i, 'wb', args.buffer_size)
+                    for i in range(args.shards)]
+        elif args.output == '-':
+            outs = [io.open(sys.stdout.fileno(), 'wb', args.buffer_size, closefd=False)]
+        else:
+            outs = [io.open(args.output, 'wb', args.buffer_size)]
+        pool = None
+        if args.processes > 1:
+            pool = _pool(args.processes)
+        count = failures = 0
+        try:
+            batches = ((lines, args.base, args.jsonl_field, args.shards, args.shard_key)
+                       for lines in _read_batches(args.files, args.batch_size, args.buffer_size))
+            if pool is None:
+                results = itertools.imap(_normalize_batch, batches)
+            else:
+                results = _imap_ordered(pool, _normalize_batch, batches, args.processes)
+            for data, batch_count, batch_failures in results:
+                if args.shards is None:
+                    data = [data]
+                for out, chunk in zip(outs, data):
+                    out.write(chunk)
+                count += batch_count
+                failures += batch_failures
+        finally:
+            for out in outs:
+                out.close()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    flush_disk_cache()
+    elapsed = time.time() - start
+    if not args.quiet:
+        sys.stderr.write('urlnorm: %d URLs in %.2fs (%d URLs/s), %d failures\n' %
+            (count, elapsed, count / (elapsed or 1e-9), failures))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())